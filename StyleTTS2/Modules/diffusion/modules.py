@@ -5,6 +5,7 @@ from .utils import *
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, reduce, repeat
 from einops.layers.torch import Rearrange
 from einops_exts import rearrange_many
@@ -37,7 +38,76 @@ class AdaLayerNorm(nn.Module):
         x = (1 + gamma) * x + beta
         return x.transpose(1, -1).transpose(-1, -2)
 
-class StyleTransformer1d(nn.Module):
+class MappingTransformer(nn.Module):
+    """Time and feature mapping shared by StyleTransformer1d and Transformer1d
+
+    Without gradients in eval mode the time embedding is cached per time_key, the Python
+    sigma the sampler denoises at (every row of time shares it), since every utterance is
+    sampled with the same schedule. The key avoids reading the time tensor back to the host.
+    The features embedding is cached for the features tensor of the utterance being sampled.
+    The caches are dropped when switching modes or loading weights.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.clear_mapping_cache()
+
+    def clear_mapping_cache(self):
+        self._time_cache = {}
+        self._features_cache = None
+
+    def train(self, mode: bool = True):
+        self.clear_mapping_cache()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_mapping_cache()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def use_mapping_cache(self) -> bool:
+        return not self.training and not torch.is_grad_enabled()
+
+    def get_time_features(self, time: Tensor, time_key: Optional[float] = None) -> Tensor:
+        if time_key is None or not self.use_mapping_cache():
+            return self.to_time(time)
+        key = (time_key, time.device, time.dtype)
+        if key not in self._time_cache:
+            self._time_cache[key] = self.to_time(time[:1])
+        return self._time_cache[key].expand(time.shape[0], -1)
+
+    def get_features(self, features: Tensor) -> Tensor:
+        if not self.use_mapping_cache():
+            return self.to_features(features)
+        if self._features_cache is None or self._features_cache[0] is not features:
+            self._features_cache = (features, self.to_features(features))
+        return self._features_cache[1]
+
+    def get_mapping(
+        self, time: Optional[Tensor] = None, features: Optional[Tensor] = None,
+        time_key: Optional[float] = None,
+    ) -> Optional[Tensor]:
+        """Combines context time features and features into mapping"""
+        items, mapping = [], None
+        # Compute time features
+        if self.use_context_time:
+            assert_message = "use_context_time=True but no time features provided"
+            assert exists(time), assert_message
+            items += [self.get_time_features(time, time_key)]
+        # Compute features
+        if self.use_context_features:
+            assert_message = "context_features exists but no features provided"
+            assert exists(features), assert_message
+            items += [self.get_features(features)]
+
+        # Compute joint mapping
+        if self.use_context_time or self.use_context_features:
+            mapping = reduce(torch.stack(items), "n b m -> b m", "sum")
+            mapping = self.to_mapping(mapping)
+
+        return mapping
+
+
+class StyleTransformer1d(MappingTransformer):
     def __init__(
         self,
         num_layers: int,
@@ -118,40 +188,23 @@ class StyleTransformer1d(nn.Module):
         )
         
 
-    def get_mapping(
-        self, time: Optional[Tensor] = None, features: Optional[Tensor] = None
-    ) -> Optional[Tensor]:
-        """Combines context time features and features into mapping"""
-        items, mapping = [], None
-        # Compute time features
-        if self.use_context_time:
-            assert_message = "use_context_time=True but no time features provided"
-            assert exists(time), assert_message
-            items += [self.to_time(time)]
-        # Compute features
-        if self.use_context_features:
-            assert_message = "context_features exists but no features provided"
-            assert exists(features), assert_message
-            items += [self.to_features(features)]
-
-        # Compute joint mapping
-        if self.use_context_time or self.use_context_features:
-            mapping = reduce(torch.stack(items), "n b m -> b m", "sum")
-            mapping = self.to_mapping(mapping)
-
-        return mapping
-            
-    def run(self, x, time, embedding, features):
+    def run(self, x, time, embedding, features, mapping=None, embedding_mask=None, time_key=None):
         
-        mapping = self.get_mapping(time, features)
+        if mapping is None:
+            mapping = self.get_mapping(time, features, time_key)
         x = torch.cat([x.expand(-1, embedding.size(1), -1), embedding], axis=-1)
         mapping = mapping.unsqueeze(1).expand(-1, embedding.size(1), -1)
         
         for block in self.blocks:
             x = x + mapping
-            x = block(x, features)
+            x = block(x, features, mask=embedding_mask)
         
-        x = x.mean(axis=1).unsqueeze(1)
+        if exists(embedding_mask):
+            # Average over the valid tokens only
+            mask = rearrange(embedding_mask, "b n -> b n 1").to(x.dtype)
+            x = ((x * mask).sum(axis=1) / mask.sum(axis=1)).unsqueeze(1)
+        else:
+            x = x.mean(axis=1).unsqueeze(1)
         x = self.to_out(x)
         x = x.transpose(-1, -2)
         
@@ -162,7 +215,13 @@ class StyleTransformer1d(nn.Module):
                 embedding_mask_proba: float = 0.0,
                 embedding: Optional[Tensor] = None, 
                 features: Optional[Tensor] = None,
-               embedding_scale: float = 1.0) -> Tensor:
+               embedding_scale: float = 1.0,
+                embedding_mask: Optional[Tensor] = None,
+                time_key: Optional[float] = None) -> Tensor:
+        """
+        embedding_mask: [b, n] bool, True for the valid tokens of padded embeddings
+        time_key: the sigma of time when all rows share it, see `MappingTransformer`
+        """
         
         b, device = embedding.shape[0], embedding.device
         fixed_embedding = self.fixed_embedding(embedding)
@@ -174,13 +233,22 @@ class StyleTransformer1d(nn.Module):
             embedding = torch.where(batch_mask, fixed_embedding, embedding)
 
         if embedding_scale != 1.0:
-            # Compute both normal and fixed embedding outputs
-            out = self.run(x, time, embedding=embedding, features=features)
-            out_masked = self.run(x, time, embedding=fixed_embedding, features=features)
+            # Compute both normal and fixed embedding outputs in a single batch
+            mapping = self.get_mapping(time, features, time_key)
+            out = self.run(
+                torch.cat([x, x]),
+                time,
+                embedding=torch.cat([embedding, fixed_embedding]),
+                features=torch.cat([features, features]) if exists(features) else None,
+                mapping=torch.cat([mapping, mapping]),
+                embedding_mask=torch.cat([embedding_mask, embedding_mask]) if exists(embedding_mask) else None,
+            )
+            out, out_masked = out.chunk(2, dim=0)
             # Scale conditional output using classifier-free guidance
             return out_masked + (out - out_masked) * embedding_scale
         else:
-            return self.run(x, time, embedding=embedding, features=features)
+            return self.run(x, time, embedding=embedding, features=features, embedding_mask=embedding_mask,
+                            time_key=time_key)
         
         return x
 
@@ -226,8 +294,8 @@ class StyleTransformerBlock(nn.Module):
 
         self.feed_forward = FeedForward(features=features, multiplier=multiplier)
 
-    def forward(self, x: Tensor, s: Tensor, *, context: Optional[Tensor] = None) -> Tensor:
-        x = self.attention(x, s) + x
+    def forward(self, x: Tensor, s: Tensor, *, context: Optional[Tensor] = None, mask: Optional[Tensor] = None) -> Tensor:
+        x = self.attention(x, s, mask=mask) + x
         if self.use_cross_attention:
             x = self.cross_attention(x, s, context=context) + x
         x = self.feed_forward(x) + x
@@ -268,7 +336,7 @@ class StyleAttention(nn.Module):
             rel_pos_max_distance=rel_pos_max_distance,
         )
 
-    def forward(self, x: Tensor, s: Tensor, *, context: Optional[Tensor] = None) -> Tensor:
+    def forward(self, x: Tensor, s: Tensor, *, context: Optional[Tensor] = None, mask: Optional[Tensor] = None) -> Tensor:
         assert_message = "You must provide a context when using context_features"
         assert not self.context_features or exists(context), assert_message
         # Use context if provided
@@ -278,9 +346,9 @@ class StyleAttention(nn.Module):
         
         q, k, v = (self.to_q(x), *torch.chunk(self.to_kv(context), chunks=2, dim=-1))
         # Compute and return attention
-        return self.attention(q, k, v)
+        return self.attention(q, k, v, mask=mask)
         
-class Transformer1d(nn.Module):
+class Transformer1d(MappingTransformer):
     def __init__(
         self,
         num_layers: int,
@@ -360,40 +428,23 @@ class Transformer1d(nn.Module):
         )
         
 
-    def get_mapping(
-        self, time: Optional[Tensor] = None, features: Optional[Tensor] = None
-    ) -> Optional[Tensor]:
-        """Combines context time features and features into mapping"""
-        items, mapping = [], None
-        # Compute time features
-        if self.use_context_time:
-            assert_message = "use_context_time=True but no time features provided"
-            assert exists(time), assert_message
-            items += [self.to_time(time)]
-        # Compute features
-        if self.use_context_features:
-            assert_message = "context_features exists but no features provided"
-            assert exists(features), assert_message
-            items += [self.to_features(features)]
-
-        # Compute joint mapping
-        if self.use_context_time or self.use_context_features:
-            mapping = reduce(torch.stack(items), "n b m -> b m", "sum")
-            mapping = self.to_mapping(mapping)
-
-        return mapping
-            
-    def run(self, x, time, embedding, features):
+    def run(self, x, time, embedding, features, mapping=None, embedding_mask=None, time_key=None):
         
-        mapping = self.get_mapping(time, features)
+        if mapping is None:
+            mapping = self.get_mapping(time, features, time_key)
         x = torch.cat([x.expand(-1, embedding.size(1), -1), embedding], axis=-1)
         mapping = mapping.unsqueeze(1).expand(-1, embedding.size(1), -1)
         
         for block in self.blocks:
             x = x + mapping
-            x = block(x)
+            x = block(x, mask=embedding_mask)
         
-        x = x.mean(axis=1).unsqueeze(1)
+        if exists(embedding_mask):
+            # Average over the valid tokens only
+            mask = rearrange(embedding_mask, "b n -> b n 1").to(x.dtype)
+            x = ((x * mask).sum(axis=1) / mask.sum(axis=1)).unsqueeze(1)
+        else:
+            x = x.mean(axis=1).unsqueeze(1)
         x = self.to_out(x)
         x = x.transpose(-1, -2)
         
@@ -404,7 +455,13 @@ class Transformer1d(nn.Module):
                 embedding_mask_proba: float = 0.0,
                 embedding: Optional[Tensor] = None, 
                 features: Optional[Tensor] = None,
-               embedding_scale: float = 1.0) -> Tensor:
+               embedding_scale: float = 1.0,
+                embedding_mask: Optional[Tensor] = None,
+                time_key: Optional[float] = None) -> Tensor:
+        """
+        embedding_mask: [b, n] bool, True for the valid tokens of padded embeddings
+        time_key: the sigma of time when all rows share it, see `MappingTransformer`
+        """
         
         b, device = embedding.shape[0], embedding.device
         fixed_embedding = self.fixed_embedding(embedding)
@@ -416,13 +473,22 @@ class Transformer1d(nn.Module):
             embedding = torch.where(batch_mask, fixed_embedding, embedding)
 
         if embedding_scale != 1.0:
-            # Compute both normal and fixed embedding outputs
-            out = self.run(x, time, embedding=embedding, features=features)
-            out_masked = self.run(x, time, embedding=fixed_embedding, features=features)
+            # Compute both normal and fixed embedding outputs in a single batch
+            mapping = self.get_mapping(time, features, time_key)
+            out = self.run(
+                torch.cat([x, x]),
+                time,
+                embedding=torch.cat([embedding, fixed_embedding]),
+                features=torch.cat([features, features]) if exists(features) else None,
+                mapping=torch.cat([mapping, mapping]),
+                embedding_mask=torch.cat([embedding_mask, embedding_mask]) if exists(embedding_mask) else None,
+            )
+            out, out_masked = out.chunk(2, dim=0)
             # Scale conditional output using classifier-free guidance
             return out_masked + (out - out_masked) * embedding_scale
         else:
-            return self.run(x, time, embedding=embedding, features=features)
+            return self.run(x, time, embedding=embedding, features=features, embedding_mask=embedding_mask,
+                            time_key=time_key)
         
         return x
 
@@ -520,17 +586,25 @@ class AttentionBase(nn.Module):
             
         self.to_out = nn.Linear(in_features=mid_features, out_features=out_features)
 
-    def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+    def forward(self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None) -> Tensor:
+        """mask: [b, m] bool, True for the keys that can be attended to"""
         # Split heads
         q, k, v = rearrange_many((q, k, v), "b n (h d) -> b h n d", h=self.num_heads)
-        # Compute similarity matrix
-        sim = einsum("... n d, ... m d -> ... n m", q, k)
-        sim = (sim + self.rel_pos(*sim.shape[-2:])) if self.use_rel_pos else sim
-        sim = sim * self.scale
-        # Get attention matrix with softmax
-        attn = sim.softmax(dim=-1)
-        # Compute values
-        out = einsum("... n m, ... m d -> ... n d", attn, v)
+        mask = rearrange(mask, "b m -> b 1 1 m") if exists(mask) else None
+        if not self.use_rel_pos:
+            # Fused kernel, its default scale is head_features ** -0.5
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        else:
+            # Compute similarity matrix
+            sim = einsum("... n d, ... m d -> ... n m", q, k)
+            sim = sim + self.rel_pos(*sim.shape[-2:])
+            sim = sim * self.scale
+            if exists(mask):
+                sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+            # Get attention matrix with softmax
+            attn = sim.softmax(dim=-1)
+            # Compute values
+            out = einsum("... n m, ... m d -> ... n d", attn, v)
         out = rearrange(out, "b h n d -> b n (h d)")
         return self.to_out(out)
 
@@ -572,7 +646,7 @@ class Attention(nn.Module):
             rel_pos_max_distance=rel_pos_max_distance,
         )
 
-    def forward(self, x: Tensor, *, context: Optional[Tensor] = None) -> Tensor:
+    def forward(self, x: Tensor, *, context: Optional[Tensor] = None, mask: Optional[Tensor] = None) -> Tensor:
         assert_message = "You must provide a context when using context_features"
         assert not self.context_features or exists(context), assert_message
         # Use context if provided
@@ -581,7 +655,7 @@ class Attention(nn.Module):
         x, context = self.norm(x), self.norm_context(context)
         q, k, v = (self.to_q(x), *torch.chunk(self.to_kv(context), chunks=2, dim=-1))
         # Compute and return attention
-        return self.attention(q, k, v)
+        return self.attention(q, k, v, mask=mask)
 
 
 """
@@ -627,8 +701,8 @@ class TransformerBlock(nn.Module):
 
         self.feed_forward = FeedForward(features=features, multiplier=multiplier)
 
-    def forward(self, x: Tensor, *, context: Optional[Tensor] = None) -> Tensor:
-        x = self.attention(x) + x
+    def forward(self, x: Tensor, *, context: Optional[Tensor] = None, mask: Optional[Tensor] = None) -> Tensor:
+        x = self.attention(x, mask=mask) + x
         if self.use_cross_attention:
             x = self.cross_attention(x, context=context) + x
         x = self.feed_forward(x) + x
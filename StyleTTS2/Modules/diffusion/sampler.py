@@ -1,4 +1,4 @@
-from math import atan, cos, pi, sin, sqrt
+from math import atan, cos, expm1, log, pi, sin, sqrt
 from typing import Any, Callable, List, Optional, Tuple, Type
 
 import torch
@@ -202,6 +202,9 @@ class KDiffusion(Diffusion):
 
         # Predict network output and add skip connection
         c_skip, c_out, c_in, c_noise = self.get_scale_weights(sigmas)
+        if isinstance(sigma, float):
+            # the net caches the time features of a sampler step by its sigma
+            kwargs = {**kwargs, "time_key": sigma}
         x_pred = self.net(c_in * x_noisy, c_noise, **kwargs)
         x_denoised = c_skip * x_noisy + c_out * x_pred
 
@@ -472,9 +475,11 @@ class AEulerSampler(Sampler):
         self, noise: Tensor, fn: Callable, sigmas: Tensor, num_steps: int
     ) -> Tensor:
         x = sigmas[0] * noise
+        # Python sigmas, read back once instead of at every step
+        sigmas_list = sigmas.tolist()
         # Denoise to sample
         for i in range(num_steps - 1):
-            x = self.step(x, fn=fn, sigma=sigmas[i], sigma_next=sigmas[i + 1])  # type: ignore # noqa
+            x = self.step(x, fn=fn, sigma=sigmas_list[i], sigma_next=sigmas_list[i + 1])
         return x
 
 
@@ -513,9 +518,11 @@ class ADPM2Sampler(Sampler):
         self, noise: Tensor, fn: Callable, sigmas: Tensor, num_steps: int
     ) -> Tensor:
         x = sigmas[0] * noise
+        # Python sigmas, read back once instead of at every step
+        sigmas_list = sigmas.tolist()
         # Denoise to sample
         for i in range(num_steps - 1):
-            x = self.step(x, fn=fn, sigma=sigmas[i], sigma_next=sigmas[i + 1])  # type: ignore # noqa
+            x = self.step(x, fn=fn, sigma=sigmas_list[i], sigma_next=sigmas_list[i + 1])
         return x
 
     def inpaint(
@@ -544,6 +551,41 @@ class ADPM2Sampler(Sampler):
         return source * mask + x * ~mask
 
 
+class DPMpp2MSampler(Sampler):
+    """DPM-Solver++(2M), https://arxiv.org/abs/2211.01095 algorithm 2
+
+    Deterministic multistep solver: one denoiser evaluation per step, the previous
+    denoised output gives the second order correction. The schedule is followed by
+    sigma 0, so the last of the num_steps evaluations returns the denoised output.
+    """
+
+    diffusion_types = [KDiffusion, VKDiffusion]
+
+    def forward(
+        self, noise: Tensor, fn: Callable, sigmas: Tensor, num_steps: int
+    ) -> Tensor:
+        x = sigmas[0] * noise
+        # KarrasSchedule ends with sigma_min then 0, other schedules end at their smallest sigma
+        sigmas_list = sigmas.tolist()[:num_steps] + [0.0]
+        old_denoised, h_last = None, None
+        for i in range(num_steps):
+            sigma, sigma_next = sigmas_list[i], sigmas_list[i + 1]
+            denoised = fn(x, sigma=sigma)
+            if sigma_next == 0:
+                x = denoised
+                break
+            # Step size in log-SNR time t = -log(sigma)
+            h = log(sigma) - log(sigma_next)
+            if old_denoised is None:
+                denoised_d = denoised
+            else:
+                r = h_last / h
+                denoised_d = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * old_denoised
+            x = (sigma_next / sigma) * x - expm1(-h) * denoised_d
+            old_denoised, h_last = denoised, h
+        return x
+
+
 """ Main Classes """
 
 
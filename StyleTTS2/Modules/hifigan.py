@@ -3,7 +3,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 from torch.nn import Conv1d, ConvTranspose1d, AvgPool1d, Conv2d
 from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
-from .utils import init_weights, get_padding
+from .utils import init_weights, get_padding, masked_instance_norm
 
 import math
 import random
@@ -17,11 +17,14 @@ class AdaIN1d(nn.Module):
         self.norm = nn.InstanceNorm1d(num_features, affine=False)
         self.fc = nn.Linear(style_dim, num_features*2)
 
-    def forward(self, x, s):
+    def forward(self, x, s, mask=None):
         h = self.fc(s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if mask is None:
+            return (1 + gamma) * self.norm(x) + beta
+        # padded batch: statistics over the valid frames, padding is zeroed for the next conv
+        return ((1 + gamma) * masked_instance_norm(x, mask, self.norm.eps) + beta) * mask
 
 class AdaINResBlock1(torch.nn.Module):
     def __init__(self, channels, kernel_size=3, dilation=(1, 3, 5), style_dim=64):
@@ -62,12 +65,12 @@ class AdaINResBlock1(torch.nn.Module):
         self.alpha2 = nn.ParameterList([nn.Parameter(torch.ones(1, channels, 1)) for i in range(len(self.convs2))])
 
 
-    def forward(self, x, s):
+    def forward(self, x, s, mask=None):
         for c1, c2, n1, n2, a1, a2 in zip(self.convs1, self.convs2, self.adain1, self.adain2, self.alpha1, self.alpha2):
-            xt = n1(x, s)
+            xt = n1(x, s, mask)
             xt = xt + (1 / a1) * (torch.sin(a1 * xt) ** 2)  # Snake1D
             xt = c1(xt)
-            xt = n2(xt, s)
+            xt = n2(xt, s, mask)
             xt = xt + (1 / a2) * (torch.sin(a2 * xt) ** 2)  # Snake1D
             xt = c2(xt)
             x = xt + x
@@ -108,6 +111,7 @@ class SineGen(torch.nn.Module):
         self.voiced_threshold = voiced_threshold
         self.flag_for_pulse = flag_for_pulse
         self.upsample_scale = upsample_scale
+        self.register_buffer('harmonics', torch.arange(1, harmonic_num + 2, dtype=torch.float32).view(1, 1, -1), persistent=False)
 
     def _f02uv(self, f0):
         # generate uv signal
@@ -196,7 +200,7 @@ class SineGen(torch.nn.Module):
         f0_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim,
                              device=f0.device)
         # fundamental component
-        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        fn = torch.multiply(f0, self.harmonics)
 
         # generate sine waveforms
         sine_waves = self._f02sine(fn) * self.sine_amp
@@ -274,6 +278,7 @@ class Generator(torch.nn.Module):
         super(Generator, self).__init__()
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
+        self.upsample_rates = upsample_rates
         resblock = AdaINResBlock1
 
         self.m_source = SourceModuleHnNSF(
@@ -318,17 +323,23 @@ class Generator(torch.nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
 
-    def forward(self, x, s, f0):
+    def forward(self, x, s, f0, mask=None):
         
         f0 = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
 
         har_source, noi_source, uv = self.m_source(f0)
         har_source = har_source.transpose(1, 2)
+        if mask is not None:
+            har_source = har_source * self.f0_upsamp(mask)
         
         for i in range(self.num_upsamples):
             x = x + (1 / self.alphas[i]) * (torch.sin(self.alphas[i] * x) ** 2)
             x_source = self.noise_convs[i](har_source)
-            x_source = self.noise_res[i](x_source, s)
+            if mask is not None:
+                # zero the padding before every conv so it does not leak into the valid samples
+                x = x * mask
+                mask = mask.repeat_interleave(self.upsample_rates[i], dim=-1)
+            x_source = self.noise_res[i](x_source, s, mask)
             
             x = self.ups[i](x)
             x = x + x_source
@@ -336,11 +347,13 @@ class Generator(torch.nn.Module):
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x, s)
+                    xs = self.resblocks[i*self.num_kernels+j](x, s, mask)
                 else:
-                    xs += self.resblocks[i*self.num_kernels+j](x, s)
+                    xs += self.resblocks[i*self.num_kernels+j](x, s, mask)
             x = xs / self.num_kernels
         x = x + (1 / self.alphas[i+1]) * (torch.sin(self.alphas[i+1] * x) ** 2)
+        if mask is not None:
+            x = x * mask
         x = self.conv_post(x)
         x = torch.tanh(x)
 
@@ -352,7 +365,6 @@ class Generator(torch.nn.Module):
             remove_weight_norm(l)
         for l in self.resblocks:
             l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
 
         
@@ -387,18 +399,21 @@ class AdainResBlk1d(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, s, mask=None):
+        x = self.norm1(x, s, mask)
         x = self.actv(x)
         x = self.pool(x)
+        if mask is not None:
+            mask = self.upsample(mask)
+            x = x * mask
         x = self.conv1(self.dropout(x))
-        x = self.norm2(x, s)
+        x = self.norm2(x, s, mask)
         x = self.actv(x)
         x = self.conv2(self.dropout(x))
         return x
 
-    def forward(self, x, s):
-        out = self._residual(x, s)
+    def forward(self, x, s, mask=None):
+        out = self._residual(x, s, mask)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
     
@@ -443,23 +458,32 @@ class Decoder(nn.Module):
         self.generator = Generator(style_dim, resblock_kernel_sizes, upsample_rates, upsample_initial_channel, resblock_dilation_sizes, upsample_kernel_sizes)
 
         
-    def forward(self, asr, F0_curve, N, s):
+    def forward(self, asr, F0_curve, N, s, mask=None):
+        """
+        mask ([B, 1, T] float, optional): valid frames of asr for a padded batch,
+        F0_curve and N are at twice the frame rate.
+        """
         if self.training:
             downlist = [0, 3, 7]
             F0_down = downlist[random.randint(0, 2)]
             downlist = [0, 3, 7, 15]
             N_down = downlist[random.randint(0, 3)]
             if F0_down:
-                F0_curve = nn.functional.conv1d(F0_curve.unsqueeze(1), torch.ones(1, 1, F0_down).to('cuda'), padding=F0_down//2).squeeze(1) / F0_down
+                F0_curve = nn.functional.conv1d(F0_curve.unsqueeze(1), torch.ones(1, 1, F0_down, device=F0_curve.device), padding=F0_down//2).squeeze(1) / F0_down
             if N_down:
-                N = nn.functional.conv1d(N.unsqueeze(1), torch.ones(1, 1, N_down).to('cuda'), padding=N_down//2).squeeze(1)  / N_down
+                N = nn.functional.conv1d(N.unsqueeze(1), torch.ones(1, 1, N_down, device=N.device), padding=N_down//2).squeeze(1)  / N_down
 
         
+        if mask is not None:
+            curve_mask = F.interpolate(mask, scale_factor=2, mode='nearest').squeeze(1)
+            F0_curve = F0_curve * curve_mask
+            N = N * curve_mask
+        
         F0 = self.F0_conv(F0_curve.unsqueeze(1))
         N = self.N_conv(N.unsqueeze(1))
         
         x = torch.cat([asr, F0, N], axis=1)
-        x = self.encode(x, s)
+        x = self.encode(x, s, mask)
         
         asr_res = self.asr_res(asr)
         
@@ -467,11 +491,13 @@ class Decoder(nn.Module):
         for block in self.decode:
             if res:
                 x = torch.cat([x, asr_res, F0, N], axis=1)
-            x = block(x, s)
+            x = block(x, s, mask)
             if block.upsample_type != "none":
                 res = False
+                if mask is not None:
+                    mask = block.upsample(mask)
                 
-        x = self.generator(x, s, F0_curve)
+        x = self.generator(x, s, F0_curve, mask)
         return x
     
     
\ No newline at end of file
@@ -3,7 +3,7 @@ import torch.nn.functional as F
 import torch.nn as nn
 from torch.nn import Conv1d, ConvTranspose1d, AvgPool1d, Conv2d
 from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
-from .utils import init_weights, get_padding
+from .utils import init_weights, get_padding, masked_instance_norm
 
 import math
 import random
@@ -18,11 +18,14 @@ class AdaIN1d(nn.Module):
         self.norm = nn.InstanceNorm1d(num_features, affine=False)
         self.fc = nn.Linear(style_dim, num_features*2)
 
-    def forward(self, x, s):
+    def forward(self, x, s, mask=None):
         h = self.fc(s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if mask is None:
+            return (1 + gamma) * self.norm(x) + beta
+        # padded batch: statistics over the valid frames, padding is zeroed for the next conv
+        return ((1 + gamma) * masked_instance_norm(x, mask, self.norm.eps) + beta) * mask
 
 class AdaINResBlock1(torch.nn.Module):
     def __init__(self, channels, kernel_size=3, dilation=(1, 3, 5), style_dim=64):
@@ -63,12 +66,12 @@ class AdaINResBlock1(torch.nn.Module):
         self.alpha2 = nn.ParameterList([nn.Parameter(torch.ones(1, channels, 1)) for i in range(len(self.convs2))])
 
 
-    def forward(self, x, s):
+    def forward(self, x, s, mask=None):
         for c1, c2, n1, n2, a1, a2 in zip(self.convs1, self.convs2, self.adain1, self.adain2, self.alpha1, self.alpha2):
-            xt = n1(x, s)
+            xt = n1(x, s, mask)
             xt = xt + (1 / a1) * (torch.sin(a1 * xt) ** 2)  # Snake1D
             xt = c1(xt)
-            xt = n2(xt, s)
+            xt = n2(xt, s, mask)
             xt = xt + (1 / a2) * (torch.sin(a2 * xt) ** 2)  # Snake1D
             xt = c2(xt)
             x = xt + x
@@ -86,12 +89,13 @@ class TorchSTFT(torch.nn.Module):
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
-        self.window = torch.from_numpy(get_window(window, win_length, fftbins=True).astype(np.float32))
+        # buffer so that it follows the module to its device instead of being copied at every call
+        self.register_buffer('window', torch.from_numpy(get_window(window, win_length, fftbins=True).astype(np.float32)), persistent=False)
 
     def transform(self, input_data):
         forward_transform = torch.stft(
             input_data,
-            self.filter_length, self.hop_length, self.win_length, window=self.window.to(input_data.device),
+            self.filter_length, self.hop_length, self.win_length, window=self.window,
             return_complex=True)
 
         return torch.abs(forward_transform), torch.angle(forward_transform)
@@ -99,7 +103,7 @@ class TorchSTFT(torch.nn.Module):
     def inverse(self, magnitude, phase):
         inverse_transform = torch.istft(
             magnitude * torch.exp(phase * 1j),
-            self.filter_length, self.hop_length, self.win_length, window=self.window.to(magnitude.device))
+            self.filter_length, self.hop_length, self.win_length, window=self.window)
 
         return inverse_transform.unsqueeze(-2)  # unsqueeze to stay consistent with conv_transpose1d implementation
 
@@ -137,6 +141,7 @@ class SineGen(torch.nn.Module):
         self.voiced_threshold = voiced_threshold
         self.flag_for_pulse = flag_for_pulse
         self.upsample_scale = upsample_scale
+        self.register_buffer('harmonics', torch.arange(1, harmonic_num + 2, dtype=torch.float32).view(1, 1, -1), persistent=False)
 
     def _f02uv(self, f0):
         # generate uv signal
@@ -225,7 +230,7 @@ class SineGen(torch.nn.Module):
         f0_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim,
                              device=f0.device)
         # fundamental component
-        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        fn = torch.multiply(f0, self.harmonics)
 
         # generate sine waveforms
         sine_waves = self._f02sine(fn) * self.sine_amp
@@ -305,6 +310,7 @@ class Generator(torch.nn.Module):
 
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
+        self.upsample_rates = upsample_rates
         resblock = AdaINResBlock1
 
         self.m_source = SourceModuleHnNSF(
@@ -347,19 +353,27 @@ class Generator(torch.nn.Module):
         self.stft = TorchSTFT(filter_length=gen_istft_n_fft, hop_length=gen_istft_hop_size, win_length=gen_istft_n_fft)
         
         
-    def forward(self, x, s, f0):
+    def forward(self, x, s, f0, mask=None):
         with torch.no_grad():
             f0 = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
 
             har_source, noi_source, uv = self.m_source(f0)
             har_source = har_source.transpose(1, 2).squeeze(1)
+            if mask is not None:
+                har_source = har_source * self.f0_upsamp(mask).squeeze(1)
             har_spec, har_phase = self.stft.transform(har_source)
             har = torch.cat([har_spec, har_phase], dim=1)
         
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
             x_source = self.noise_convs[i](har)
-            x_source = self.noise_res[i](x_source, s)
+            if mask is not None:
+                # zero the padding before every conv so it does not leak into the valid frames
+                x = x * mask
+                mask = mask.repeat_interleave(self.upsample_rates[i], dim=-1)
+                if i == self.num_upsamples - 1:
+                    mask = F.pad(mask, (1, 0), value=1)
+            x_source = self.noise_res[i](x_source, s, mask)
 
             x = self.ups[i](x)
             if i == self.num_upsamples - 1:
@@ -369,11 +383,13 @@ class Generator(torch.nn.Module):
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x, s)
+                    xs = self.resblocks[i*self.num_kernels+j](x, s, mask)
                 else:
-                    xs += self.resblocks[i*self.num_kernels+j](x, s)
+                    xs += self.resblocks[i*self.num_kernels+j](x, s, mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
+        if mask is not None:
+            x = x * mask
         x = self.conv_post(x)
         spec = torch.exp(x[:,:self.post_n_fft // 2 + 1, :])
         phase = torch.sin(x[:, self.post_n_fft // 2 + 1:, :])
@@ -403,7 +419,6 @@ class Generator(torch.nn.Module):
             remove_weight_norm(l)
         for l in self.resblocks:
             l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
 
         
@@ -438,18 +453,21 @@ class AdainResBlk1d(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, s, mask=None):
+        x = self.norm1(x, s, mask)
         x = self.actv(x)
         x = self.pool(x)
+        if mask is not None:
+            mask = self.upsample(mask)
+            x = x * mask
         x = self.conv1(self.dropout(x))
-        x = self.norm2(x, s)
+        x = self.norm2(x, s, mask)
         x = self.actv(x)
         x = self.conv2(self.dropout(x))
         return x
 
-    def forward(self, x, s):
-        out = self._residual(x, s)
+    def forward(self, x, s, mask=None):
+        out = self._residual(x, s, mask)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
     
@@ -496,23 +514,32 @@ class Decoder(nn.Module):
                                    upsample_initial_channel, resblock_dilation_sizes, 
                                    upsample_kernel_sizes, gen_istft_n_fft, gen_istft_hop_size)
         
-    def forward(self, asr, F0_curve, N, s):
+    def forward(self, asr, F0_curve, N, s, mask=None):
+        """
+        mask ([B, 1, T] float, optional): valid frames of asr for a padded batch,
+        F0_curve and N are at twice the frame rate.
+        """
         if self.training:
             downlist = [0, 3, 7]
             F0_down = downlist[random.randint(0, 2)]
             downlist = [0, 3, 7, 15]
             N_down = downlist[random.randint(0, 3)]
             if F0_down:
-                F0_curve = nn.functional.conv1d(F0_curve.unsqueeze(1), torch.ones(1, 1, F0_down).to('cuda'), padding=F0_down//2).squeeze(1) / F0_down
+                F0_curve = nn.functional.conv1d(F0_curve.unsqueeze(1), torch.ones(1, 1, F0_down, device=F0_curve.device), padding=F0_down//2).squeeze(1) / F0_down
             if N_down:
-                N = nn.functional.conv1d(N.unsqueeze(1), torch.ones(1, 1, N_down).to('cuda'), padding=N_down//2).squeeze(1)  / N_down
+                N = nn.functional.conv1d(N.unsqueeze(1), torch.ones(1, 1, N_down, device=N.device), padding=N_down//2).squeeze(1)  / N_down
 
         
+        if mask is not None:
+            curve_mask = F.interpolate(mask, scale_factor=2, mode='nearest').squeeze(1)
+            F0_curve = F0_curve * curve_mask
+            N = N * curve_mask
+        
         F0 = self.F0_conv(F0_curve.unsqueeze(1))
         N = self.N_conv(N.unsqueeze(1))
         
         x = torch.cat([asr, F0, N], axis=1)
-        x = self.encode(x, s)
+        x = self.encode(x, s, mask)
         
         asr_res = self.asr_res(asr)
         
@@ -520,11 +547,13 @@ class Decoder(nn.Module):
         for block in self.decode:
             if res:
                 x = torch.cat([x, asr_res, F0, N], axis=1)
-            x = block(x, s)
+            x = block(x, s, mask)
             if block.upsample_type != "none":
                 res = False
+                if mask is not None:
+                    mask = block.upsample(mask)
                 
-        x = self.generator(x, s, F0_curve)
+        x = self.generator(x, s, F0_curve, mask)
         return x
     
     
\ No newline at end of file
@@ -17,6 +17,28 @@ class SLMAdversarialLoss(torch.nn.Module):
         self.sig = sig
         self.skip_update = skip_update
         
+    def _gaussian_upsampling(self, d, dur_pred, token_mask, output_lengths):
+        """
+        Soft alignment [B, T_text, T_frames] of the duration logits d [B, T_text, max_dur]. Every token is
+        a grouped convolution channel with a Gaussian kernel centered on its predicted position. The
+        kernels of all utterances are padded to the longest output, which leaves the first
+        output_lengths frames of every utterance as with a kernel of its own length.
+        """
+        batch_size, text_length, max_dur = d.shape
+        l = max(output_lengths)
+        t = torch.arange(0, l, device=d.device)
+        loc = torch.cumsum(dur_pred, dim=1) - dur_pred / 2
+
+        h = torch.exp(-0.5 * torch.square(t - (l - loc.unsqueeze(-1))) / (self.sig)**2)
+
+        out = F.conv1d(d.reshape(1, batch_size * text_length, max_dur),
+                       h.reshape(batch_size * text_length, 1, l),
+                       padding=l - 1, groups=batch_size * text_length)[..., :l]
+        out = out.view(batch_size, text_length, l).masked_fill(~token_mask[..., None], float('-inf'))
+
+        frame_mask = t[None, :] < torch.tensor(output_lengths, device=d.device)[:, None]
+        return F.softmax(out, dim=1) * frame_mask[:, None, :]
+
     def forward(self, iters, y_rec_gt, y_rec_gt_pred, waves, mel_input_length, ref_text, ref_lengths, use_ind, s_trg, ref_s=None):
         text_mask = length_to_mask(ref_lengths).to(ref_text.device)
         bert_dur = self.model.bert(ref_text, attention_mask=(~text_mask).int())
@@ -48,42 +70,18 @@ class SLMAdversarialLoss(torch.nn.Module):
                                                 torch.randn(ref_lengths.shape[0], ref_lengths.max(), 2).to(ref_text.device), 
                                                 text_mask)
         
-        bib = 0
-
-        output_lengths = []
-        attn_preds = []
-        
-        # differentiable duration modeling
-        for _s2s_pred, _text_length in zip(d, ref_lengths):
-
-            _s2s_pred_org = _s2s_pred[:_text_length, :]
-
-            _s2s_pred = torch.sigmoid(_s2s_pred_org)
-            _dur_pred = _s2s_pred.sum(axis=-1)
+        token_mask = torch.arange(d.shape[1], device=d.device)[None, :] < ref_lengths[:, None]
+        dur_pred = torch.sigmoid(d).masked_fill(~token_mask[..., None], 0).sum(axis=-1)
 
-            l = int(torch.round(_s2s_pred.sum()).item())
-            t = torch.arange(0, l).expand(l)
+        # the only host sync, frame counts of the predicted and of the ground truth mels
+        output_lengths, gt_lengths = torch.stack([torch.round(dur_pred.sum(axis=-1)).long(),
+                                                  mel_input_length.long() // 2]).tolist()
 
-            t = torch.arange(0, l).unsqueeze(0).expand((len(_s2s_pred), l)).to(ref_text.device)
-            loc = torch.cumsum(_dur_pred, dim=0) - _dur_pred / 2
-
-            h = torch.exp(-0.5 * torch.square(t - (l - loc.unsqueeze(-1))) / (self.sig)**2)
-
-            out = torch.nn.functional.conv1d(_s2s_pred_org.unsqueeze(0), 
-                                         h.unsqueeze(1), 
-                                         padding=h.shape[-1] - 1, groups=int(_text_length))[..., :l]
-            attn_preds.append(F.softmax(out.squeeze(), dim=0))
-
-            output_lengths.append(l)
-
-        max_len = max(output_lengths)
+        # differentiable duration modeling
+        s2s_attn = self._gaussian_upsampling(d, dur_pred, token_mask, output_lengths)
         
         with torch.no_grad():
             t_en = self.model.text_encoder(ref_text, ref_lengths, text_mask)
-            
-        s2s_attn = torch.zeros(len(ref_lengths), int(ref_lengths.max()), max_len).to(ref_text.device)
-        for bib in range(len(output_lengths)):
-            s2s_attn[bib, :ref_lengths[bib], :output_lengths[bib]] = attn_preds[bib]
 
         asr_pred = t_en @ s2s_attn
 
@@ -95,44 +93,25 @@ class SLMAdversarialLoss(torch.nn.Module):
         mel_len = max(int(min(output_lengths) / 2 - 1), self.min_len // 2)
         mel_len = min(mel_len, self.max_len // 2)
         
-        # get clips
-        
-        en = []
-        p_en = []
-        sp = []
-        
-        F0_fakes = []
-        N_fakes = []
-        
-        wav = []
-
-        for bib in range(len(output_lengths)):
-            mel_length_pred = output_lengths[bib]
-            mel_length_gt = int(mel_input_length[bib].item() / 2)
-            if mel_length_gt <= mel_len or mel_length_pred <= mel_len:
-                continue
-
-            sp.append(s_preds[bib])
+        # get clips, from the first utterances long enough, up to batch_percentage of the batch to prevent OOM
+        selected = [bib for bib in range(len(output_lengths))
+                    if gt_lengths[bib] > mel_len and output_lengths[bib] > mel_len]
+        selected = selected[:max(1, int(np.ceil(self.batch_percentage * len(waves))))]
 
-            random_start = np.random.randint(0, mel_length_pred - mel_len)
-            en.append(asr_pred[bib, :, random_start:random_start+mel_len])
-            p_en.append(p_pred[bib, :, random_start:random_start+mel_len])
-
-            # get ground truth clips
-            random_start = np.random.randint(0, mel_length_gt - mel_len)
-            y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-            wav.append(torch.from_numpy(y).to(ref_text.device))
-            
-            if len(wav) >= self.batch_percentage * len(waves): # prevent OOM due to longer lengths
-                break
-
-        if len(sp) <= 1:
+        if len(selected) <= 1:
             return None
-            
-        sp = torch.stack(sp)
-        wav = torch.stack(wav).float()
-        en = torch.stack(en)
-        p_en = torch.stack(p_en)
+
+        pred_starts = np.random.randint(0, np.array(output_lengths)[selected] - mel_len)
+        gt_starts = np.random.randint(0, np.array(gt_lengths)[selected] - mel_len)
+        selected = torch.tensor(selected, device=d.device)
+        frames = torch.from_numpy(pred_starts).to(d.device)[:, None] + torch.arange(mel_len, device=d.device)
+        samples = torch.from_numpy(gt_starts * 600).to(d.device)[:, None] + torch.arange(mel_len * 600, device=d.device)
+
+        sp = s_preds[selected]
+        en = asr_pred[selected].gather(2, frames[:, None, :].expand(-1, asr_pred.shape[1], -1))
+        p_en = p_pred[selected].gather(2, frames[:, None, :].expand(-1, p_pred.shape[1], -1))
+        # ground truth clips
+        wav = waves[selected].gather(1, samples).float()
         
         F0_fake, N_fake = self.model.predictor.F0Ntrain(p_en, sp[:, 128:])
         y_pred = self.model.decoder(en, F0_fake, N_fake, sp[:, :128])
@@ -1,3 +1,5 @@
+import torch
+
 def init_weights(m, mean=0.0, std=0.01):
     classname = m.__class__.__name__
     if classname.find("Conv") != -1:
@@ -11,4 +13,11 @@ def apply_weight_norm(m):
 
 
 def get_padding(kernel_size, dilation=1):
-    return int((kernel_size*dilation - dilation)/2)
\ No newline at end of file
+    return int((kernel_size*dilation - dilation)/2)
+
+def masked_instance_norm(x, mask, eps=1e-5):
+    # instance norm over the valid frames only, mask is [B, 1, T] with 1 for valid frames
+    n = mask.sum(dim=-1, keepdim=True).clamp(min=1)
+    mean = (x * mask).sum(dim=-1, keepdim=True) / n
+    var = (((x - mean) * mask) ** 2).sum(dim=-1, keepdim=True) / n
+    return (x - mean) / torch.sqrt(var + eps)
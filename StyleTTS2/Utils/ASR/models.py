@@ -1,4 +1,6 @@
 import math
+from typing import List, Optional, Tuple
+
 import torch
 from torch import nn
 from torch.nn import TransformerEncoder
@@ -12,7 +14,7 @@ class ASRCNN(nn.Module):
                  n_token=35,
                  n_layers=6,
                  token_embedding_dim=256,
-
+                 script_decoder=False,
     ):
         super().__init__()
         self.n_token = n_token
@@ -32,7 +34,8 @@ class ASRCNN(nn.Module):
         self.asr_s2s = ASRS2S(
             embedding_dim=token_embedding_dim,
             hidden_dim=hidden_dim//2,
-            n_token=n_token)
+            n_token=n_token,
+            script_decoder=script_decoder)
 
     def forward(self, x, src_key_padding_mask=None, text_input=None):
         x = self.to_mfcc(x)
@@ -71,13 +74,66 @@ class ASRCNN(nn.Module):
         mask = torch.gt(index_tensor, index_tensor.T + unmask_future_steps)
         return mask
 
+def _decode_steps(decoder_inputs: torch.Tensor, memory: torch.Tensor, processed_memory: torch.Tensor,
+                  mask: Optional[torch.Tensor], weight_ih: torch.Tensor, weight_hh: torch.Tensor,
+                  bias_ih: torch.Tensor, bias_hh: torch.Tensor, query_weight: torch.Tensor,
+                  location_conv_weight: torch.Tensor, location_dense_weight: torch.Tensor,
+                  v_weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Teacher forced recurrence of ASRS2S, the LSTM cell and the location sensitive attention of
+    every step with the ops of the modules, so the attention is the same bit for bit. Scriptable.
+    Returns the decoder hidden states, attention contexts and attention weights, [T, B, *].
+    """
+    B, L, H = memory.size(0), memory.size(1), memory.size(2)
+    decoder_hidden = memory.new_zeros((B, weight_hh.size(1)))
+    decoder_cell = memory.new_zeros((B, weight_hh.size(1)))
+    attention_context = memory.new_zeros((B, H))
+    # previous and cumulative attention weights, the input of the location conv
+    attention_state = memory.new_zeros((B, 2, L))
+    padding = (location_conv_weight.size(2) - 1) // 2
+
+    hiddens: List[torch.Tensor] = []
+    contexts: List[torch.Tensor] = []
+    alignments: List[torch.Tensor] = []
+    for i in range(decoder_inputs.size(0)):
+        cell_input = torch.cat((decoder_inputs[i], attention_context), -1)
+        decoder_hidden, decoder_cell = torch.lstm_cell(
+            cell_input, [decoder_hidden, decoder_cell], weight_ih, weight_hh, bias_ih, bias_hh)
+
+        processed_query = F.linear(decoder_hidden.unsqueeze(1), query_weight)
+        processed_attention = torch.conv1d(attention_state, location_conv_weight, None, [1], [padding])
+        processed_attention = F.linear(processed_attention.transpose(1, 2), location_dense_weight)
+        energies = F.linear(torch.tanh(processed_query + processed_attention + processed_memory), v_weight)
+        energies = energies.squeeze(-1)
+        if mask is not None:
+            energies = energies.masked_fill(mask, -float("inf"))
+
+        attention_weights = torch.softmax(energies, dim=1)
+        attention_context = torch.bmm(attention_weights.unsqueeze(1), memory).squeeze(1)
+        attention_state = torch.stack((attention_weights, attention_state[:, 1] + attention_weights), dim=1)
+
+        hiddens.append(decoder_hidden)
+        contexts.append(attention_context)
+        alignments.append(attention_weights)
+
+    return torch.stack(hiddens), torch.stack(contexts), torch.stack(alignments)
+
+_scripted_decode_steps = None
+
+def scripted_decode_steps():
+    global _scripted_decode_steps
+    if _scripted_decode_steps is None:
+        _scripted_decode_steps = torch.jit.script(_decode_steps)
+    return _scripted_decode_steps
+
 class ASRS2S(nn.Module):
     def __init__(self,
                  embedding_dim=256,
                  hidden_dim=512,
                  n_location_filters=32,
                  location_kernel_size=63,
-                 n_token=40):
+                 n_token=40,
+                 script_decoder=False):
         super(ASRS2S, self).__init__()
         self.embedding = nn.Embedding(n_token, embedding_dim)
         val_range = math.sqrt(6 / hidden_dim)
@@ -98,22 +154,10 @@ class ASRS2S(nn.Module):
             nn.Tanh())
         self.sos = 1
         self.eos = 2
-
-    def initialize_decoder_states(self, memory, mask):
-        """
-        moemory.shape = (B, L, H) = (Batchsize, Maxtimestep, Hiddendim)
-        """
-        B, L, H = memory.shape
-        self.decoder_hidden = torch.zeros((B, self.decoder_rnn_dim)).type_as(memory)
-        self.decoder_cell = torch.zeros((B, self.decoder_rnn_dim)).type_as(memory)
-        self.attention_weights = torch.zeros((B, L)).type_as(memory)
-        self.attention_weights_cum = torch.zeros((B, L)).type_as(memory)
-        self.attention_context = torch.zeros((B, H)).type_as(memory)
-        self.memory = memory
-        self.processed_memory = self.attention_layer.memory_layer(memory)
-        self.mask = mask
         self.unk_index = 3
         self.random_mask = 0.1
+        # run the decode loop with TorchScript instead of the python interpreter
+        self.script_decoder = script_decoder
 
     def forward(self, memory, memory_mask, text_input):
         """
@@ -121,7 +165,6 @@ class ASRS2S(nn.Module):
         moemory_mask.shape = (B, L, )
         texts_input.shape = (B, T)
         """
-        self.initialize_decoder_states(memory, memory_mask)
         # text random mask
         random_mask = (torch.rand(text_input.shape) < self.random_mask).to(text_input.device)
         _text_input = text_input.clone()
@@ -131,56 +174,30 @@ class ASRS2S(nn.Module):
             torch.LongTensor([self.sos]*decoder_inputs.size(1)).to(decoder_inputs.device))
         decoder_inputs = torch.cat((start_embedding.unsqueeze(0), decoder_inputs), dim=0)
 
-        hidden_outputs, logit_outputs, alignments = [], [], []
-        while len(hidden_outputs) < decoder_inputs.size(0):
-
-            decoder_input = decoder_inputs[len(hidden_outputs)]
-            hidden, logit, attention_weights = self.decode(decoder_input)
-            hidden_outputs += [hidden]
-            logit_outputs += [logit]
-            alignments += [attention_weights]
-
-        hidden_outputs, logit_outputs, alignments = \
-            self.parse_decoder_outputs(
-                hidden_outputs, logit_outputs, alignments)
-
-        return hidden_outputs, logit_outputs, alignments
-
-
-    def decode(self, decoder_input):
-
-        cell_input = torch.cat((decoder_input, self.attention_context), -1)
-        self.decoder_hidden, self.decoder_cell = self.decoder_rnn(
-            cell_input,
-            (self.decoder_hidden, self.decoder_cell))
-
-        attention_weights_cat = torch.cat(
-            (self.attention_weights.unsqueeze(1),
-            self.attention_weights_cum.unsqueeze(1)),dim=1)
-
-        self.attention_context, self.attention_weights = self.attention_layer(
-            self.decoder_hidden,
-            self.memory,
-            self.processed_memory,
-            attention_weights_cat,
-            self.mask)
-
-        self.attention_weights_cum += self.attention_weights
-
-        hidden_and_context = torch.cat((self.decoder_hidden, self.attention_context), -1)
-        hidden = self.project_to_hidden(hidden_and_context)
-
+        # only the LSTM cell and the attention are sequential, the projections run on all steps at once
+        attention = self.attention_layer
+        decode_steps = scripted_decode_steps() if self.script_decoder else _decode_steps
+        decoder_hidden, attention_context, alignments = decode_steps(
+            decoder_inputs, memory, attention.memory_layer(memory), memory_mask,
+            self.decoder_rnn.weight_ih, self.decoder_rnn.weight_hh,
+            self.decoder_rnn.bias_ih, self.decoder_rnn.bias_hh,
+            attention.query_layer.linear_layer.weight,
+            attention.location_layer.location_conv.conv.weight,
+            attention.location_layer.location_dense.linear_layer.weight,
+            attention.v.linear_layer.weight)
+
+        hidden = self.project_to_hidden(torch.cat((decoder_hidden, attention_context), -1))
         # dropout to increasing g
         logit = self.project_to_n_symbols(F.dropout(hidden, 0.5, self.training))
 
-        return hidden, logit, self.attention_weights
+        return self.parse_decoder_outputs(hidden, logit, alignments)
 
     def parse_decoder_outputs(self, hidden, logit, alignments):
 
-        # -> [B, T_out + 1, max_time]
-        alignments = torch.stack(alignments).transpose(0,1)
+        # [T_out + 1, B, max_time] -> [B, T_out + 1, max_time]
+        alignments = alignments.transpose(0,1)
         # [T_out + 1, B, n_symbols] -> [B, T_out + 1,  n_symbols]
-        logit = torch.stack(logit).transpose(0, 1).contiguous()
-        hidden = torch.stack(hidden).transpose(0, 1).contiguous()
+        logit = logit.transpose(0, 1).contiguous()
+        hidden = hidden.transpose(0, 1).contiguous()
 
         return hidden, logit, alignments
@@ -1,8 +1,12 @@
 import os
 import yaml
 import torch
+from collections import OrderedDict
 from transformers import AlbertConfig, AlbertModel
 
+# clean AlbertModel state written by `convert_plbert`, loaded instead of the training checkpoint when fresh
+CONVERTED_NAME = "plbert.pth"
+
 class CustomAlbert(AlbertModel):
     def forward(self, *args, **kwargs):
         # Call the original forward method
@@ -12,24 +16,29 @@ class CustomAlbert(AlbertModel):
         return outputs.last_hidden_state
 
 
-def load_plbert(log_dir):
-    config_path = os.path.join(log_dir, "config.yml")
-    plbert_config = yaml.safe_load(open(config_path))
-    
-    albert_base_configuration = AlbertConfig(**plbert_config['model_params'])
-    bert = CustomAlbert(albert_base_configuration)
+def build_plbert(model_params):
+    # architecture only, weights are loaded by the caller
+    albert_base_configuration = AlbertConfig(**model_params)
+    return CustomAlbert(albert_base_configuration)
 
-    files = os.listdir(log_dir)
+def latest_checkpoint(log_dir):
     ckpts = []
     for f in os.listdir(log_dir):
         if f.startswith("step_"): ckpts.append(f)
 
     iters = [int(f.split('_')[-1].split('.')[0]) for f in ckpts if os.path.isfile(os.path.join(log_dir, f))]
+    if len(iters) == 0:
+        return None
     iters = sorted(iters)[-1]
+    return os.path.join(log_dir, "step_" + str(iters) + ".t7")
+
+def _source_info(path):
+    stat = os.stat(path)
+    return {'source': os.path.basename(path), 'source_size': stat.st_size, 'source_mtime': stat.st_mtime_ns}
 
-    checkpoint = torch.load(log_dir + "/step_" + str(iters) + ".t7", map_location='cpu', weights_only=False)
+def _load_training_state(path):
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
     state_dict = checkpoint['net']
-    from collections import OrderedDict
     new_state_dict = OrderedDict()
     for k, v in state_dict.items():
         name = k[7:] # remove `module.`
@@ -37,6 +46,65 @@ def load_plbert(log_dir):
             name = name[8:] # remove `encoder.`
             new_state_dict[name] = v
     del new_state_dict["embeddings.position_ids"]
-    bert.load_state_dict(new_state_dict, strict=False)
-    
+    return new_state_dict
+
+def convert_plbert(log_dir, output_path=None):
+    """Writes the AlbertModel state of the latest step_*.t7 in log_dir, tagged with the checkpoint it comes from."""
+    ckpt_path = latest_checkpoint(log_dir)
+    assert ckpt_path is not None, 'No step_*.t7 checkpoint in %s' % log_dir
+    output_path = output_path or os.path.join(log_dir, CONVERTED_NAME)
+
+    state = _source_info(ckpt_path)
+    state['net'] = _load_training_state(ckpt_path)
+    torch.save(state, output_path)
+    return output_path
+
+def _load_converted_state(log_dir, ckpt_path):
+    converted_path = os.path.join(log_dir, CONVERTED_NAME)
+    if not os.path.isfile(converted_path):
+        return None
+    state = torch.load(converted_path, map_location='cpu', mmap=True, weights_only=True)
+    # stale if a newer or different training checkpoint is in the directory
+    if ckpt_path is not None and {k: state[k] for k in ['source', 'source_size', 'source_mtime']} != _source_info(ckpt_path):
+        print('%s is out of date, run convert_plbert.py to refresh it' % converted_path)
+        return None
+    return state['net']
+
+def load_plbert(log_dir):
+    config_path = os.path.join(log_dir, "config.yml")
+    plbert_config = yaml.safe_load(open(config_path))
+
+    bert = build_plbert(plbert_config['model_params'])
+
+    ckpt_path = latest_checkpoint(log_dir)
+    state_dict = _load_converted_state(log_dir, ckpt_path)
+    if state_dict is None:
+        assert ckpt_path is not None, 'No step_*.t7 checkpoint or %s in %s' % (CONVERTED_NAME, log_dir)
+        state_dict = _load_training_state(ckpt_path)
+    bert.load_state_dict(state_dict, strict=False)
+
     return bert
+
+def export_plbert(bert, torchscript_path=None, onnx_path=None):
+    """
+    Traces a PL-BERT for inference, call it on an eval (or frozen) model. The traced module
+    takes (input_ids, attention_mask) positionally and returns the last hidden state.
+    """
+    input_ids = torch.ones(1, 64, dtype=torch.long)
+    attention_mask = torch.ones(1, 64, dtype=torch.long)
+    device = next(bert.parameters()).device
+    input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+
+    if torchscript_path is not None:
+        with torch.no_grad():
+            traced = torch.jit.trace(bert, (input_ids, attention_mask), strict=False)
+        traced.save(torchscript_path)
+
+    if onnx_path is not None:
+        torch.onnx.export(bert, (input_ids, attention_mask), onnx_path,
+                          input_names=['input_ids', 'attention_mask'],
+                          output_names=['last_hidden_state'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'length'},
+                                        'attention_mask': {0: 'batch', 1: 'length'},
+                                        'last_hidden_state': {0: 'batch', 1: 'length'}},
+                          opset_version=14)
@@ -0,0 +1,62 @@
+#coding:utf-8
+import time
+
+import click
+import torch
+
+from utils import maximum_path_cython, maximum_path_torch, maximum_path_numba, numba
+
+def random_batch(batch_size, max_text, generator):
+    # log attention of random texts, every token gets 2 to 5 mel frames (after the aligner downsampling)
+    text_lengths = torch.randint(max_text // 2, max_text + 1, (batch_size,), generator=generator)
+    text_lengths[0] = max_text
+    mel_lengths = text_lengths * torch.randint(2, 6, (batch_size,), generator=generator)
+    neg_cent = torch.randn(batch_size, max_text, int(mel_lengths.max()), generator=generator).log_softmax(dim=1)
+    mask = (torch.arange(max_text)[None, :, None] < text_lengths[:, None, None]) & \
+           (torch.arange(neg_cent.shape[-1])[None, None, :] < mel_lengths[:, None, None])
+    return neg_cent, mask.float()
+
+def timed(fn, runs, cuda):
+    fn() # warm up, numba compiles on the first call
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(runs):
+        out = fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return out, 1000 * (time.time() - start) / runs
+
+@click.command()
+@click.option('--batch_size', default=16, type=int)
+@click.option('--sizes', default='50,100,200', type=str, help='comma separated longest texts of the batches')
+@click.option('--runs', default=10, type=int)
+@click.option('--seed', default=0, type=int)
+def main(batch_size, sizes, runs, seed):
+    """Checks that the torch and numba monotonic alignment searches give the paths of maximum_path_c, and times them."""
+    generator = torch.Generator().manual_seed(seed)
+    implementations = [('torch-cpu', lambda n, m: maximum_path_torch(n, m.sum(1)[:, 0].long(), m.sum(2)[:, 0].long()))]
+    if numba is not None:
+        implementations.append(('numba', maximum_path_numba))
+    if torch.cuda.is_available():
+        implementations.append(('torch-cuda', lambda n, m: maximum_path_torch(n.cuda(), m.sum(1)[:, 0].long().cuda(),
+                                                                            m.sum(2)[:, 0].long().cuda()).cpu()))
+
+    print('%-12s %16s %10s %8s' % ('impl', 'shape', 'ms', 'equal'))
+    failed = False
+    for max_text in [int(n) for n in sizes.split(',')]:
+        neg_cent, mask = random_batch(batch_size, max_text, generator)
+        shape = 'x'.join(str(n) for n in neg_cent.shape)
+        reference, ms = timed(lambda: maximum_path_cython(neg_cent, mask), runs, False)
+        print('%-12s %16s %10.2f %8s' % ('cython', shape, ms, '-'))
+        for name, fn in implementations:
+            path, ms = timed(lambda: fn(neg_cent, mask), runs, name == 'torch-cuda')
+            equal = torch.equal(path.to(reference.dtype), reference)
+            failed = failed or not equal
+            print('%-12s %16s %10.2f %8s' % (name, shape, ms, equal))
+
+    if failed:
+        raise SystemExit('some paths differ from maximum_path_c')
+
+if __name__=="__main__":
+    main()
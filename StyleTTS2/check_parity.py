@@ -0,0 +1,42 @@
+#coding:utf-8
+import click
+import numpy as np
+import torch
+
+from inference import InferenceEngine
+
+@click.command()
+@click.option('-p', '--config_path', default='Configs/config_darija_ft.yml', type=str)
+@click.option('-m', '--model_path', required=True, type=str)
+@click.option('-r', '--reference', default=None, type=str, help='reference wav, required for multispeaker models')
+@click.option('--max_items', default=10, type=int)
+@click.option('--atol', default=1e-4, type=float)
+@click.option('--seed', default=0, type=int)
+def main(config_path, model_path, reference, max_items, atol, seed):
+    """Checks that `freeze_for_inference` does not change the synthesized audio of the validation texts."""
+    # two engines rather than a deepcopy, modules with weight_norm hooks cannot be deep copied
+    engines = [InferenceEngine(config_path, model_path, freeze=False),
+               InferenceEngine(config_path, model_path, freeze=True)]
+    engine = engines[0]
+    ref_style = engine.compute_style(reference) if reference is not None else None
+
+    with open(engine.config['data_params']['val_data'], 'r', encoding='utf-8') as f:
+        texts = [l.strip().split('|')[1] for l in f.readlines() if l.strip()][:max_items]
+
+    worst = 0
+    for text in texts:
+        wavs = []
+        for e in engines:
+            # same seed so both runs draw the same diffusion and source noise
+            torch.manual_seed(seed)
+            wavs.append(e.synthesize(text, ref_style))
+        err = np.abs(wavs[0] - wavs[1]).max()
+        worst = max(worst, err)
+        print('%.2e  %s' % (err, text))
+
+    print('max abs error %.2e (atol %.0e)' % (worst, atol))
+    if worst > atol:
+        raise SystemExit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,76 @@
+#coding:utf-8
+import time
+
+import click
+import torch
+
+from inference import InferenceEngine, build_sampler as build_diffusion_sampler
+
+def build_sampler(engine, name):
+    sampler = build_diffusion_sampler(engine.model.diffusion, name)
+    # count denoiser evaluations
+    denoise_fn = sampler.denoise_fn
+    sampler.nfe = 0
+    def counted(*args, **kwargs):
+        sampler.nfe += 1
+        return denoise_fn(*args, **kwargs)
+    sampler.denoise_fn = counted
+    return sampler
+
+def read_val_list(path, root_path, max_items):
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [l.strip().split('|') for l in f.readlines() if l.strip()]
+    return [(root_path + l[0], l[1]) for l in lines[:max_items]]
+
+@click.command()
+@click.option('-p', '--config_path', default='Configs/config_darija_ft.yml', type=str)
+@click.option('-m', '--model_path', required=True, type=str)
+@click.option('--max_items', default=50, type=int)
+@click.option('--ref_steps', default=10, type=int, help='ADPM2 steps of the reference styles')
+@click.option('--runs', default='adpm2:5,adpm2:10,dpmpp2m:4,dpmpp2m:5,dpmpp2m:6', type=str, help='comma separated sampler:num_steps')
+@click.option('--embedding_scale', default=1.0, type=float)
+@click.option('--seed', default=0, type=int)
+def main(config_path, model_path, max_items, ref_steps, runs, embedding_scale, seed):
+    """Compares diffusion samplers against ADPM2 on the validation list: NFE, wall time and style distance."""
+    engine = InferenceEngine(config_path, model_path)
+    data_params = engine.config['data_params']
+    items = read_val_list(data_params['val_data'], data_params.get('root_path', ''), max_items)
+
+    # the PL-BERT embeddings, reference styles and noise are shared by every run
+    inputs = []
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for wav_path, text in items:
+            tokens = engine.tokenize(text)
+            bert_dur = engine.model.bert(tokens, torch.ones_like(tokens))
+            features = {'features': engine.compute_style(wav_path)} if engine.multispeaker else {}
+            noise = torch.randn((1, 1, engine.style_dim * 2), generator=generator).to(engine.device)
+            inputs.append((bert_dur, features, noise))
+
+    def sample(sampler, num_steps):
+        # ADPM2 adds noise at every step, reseed so every run sees the same draws
+        torch.manual_seed(seed)
+        styles = []
+        with torch.no_grad():
+            for bert_dur, features, noise in inputs:
+                styles.append(sampler(noise=noise, embedding=bert_dur, embedding_scale=embedding_scale,
+                                      num_steps=num_steps, **features).squeeze(1))
+        return torch.cat(styles, dim=0)
+
+    reference = sample(build_sampler(engine, 'adpm2'), ref_steps)
+
+    print('%-10s %6s %8s %12s %10s %10s' % ('sampler', 'steps', 'NFE/utt', 'ms/utt', 'L2', 'cosine'))
+    for run in runs.split(','):
+        name, num_steps = run.split(':')
+        sampler = build_sampler(engine, name)
+        start = time.time()
+        styles = sample(sampler, int(num_steps))
+        elapsed = time.time() - start
+
+        l2 = (styles - reference).norm(dim=-1).mean().item()
+        cosine = torch.nn.functional.cosine_similarity(styles, reference, dim=-1).mean().item()
+        print('%-10s %6s %8.1f %12.2f %10.4f %10.4f' % (name, num_steps, sampler.nfe / len(inputs),
+                                                        1000 * elapsed / len(inputs), l2, cosine))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,34 @@
+#coding:utf-8
+import os.path as osp
+
+import click
+
+from Utils.PLBERT.util import convert_plbert, export_plbert, latest_checkpoint
+
+@click.command()
+@click.option('--plbert_dir', default='Utils/PLBERT/', type=str)
+@click.option('-m', '--model_path', default=None, type=str, help='checkpoint whose (finetuned) PL-BERT is traced')
+@click.option('-p', '--config_path', default='Configs/config_darija_ft.yml', type=str)
+@click.option('--torchscript', default=None, type=str, help='output path of the TorchScript PL-BERT')
+@click.option('--onnx', default=None, type=str, help='output path of the ONNX PL-BERT')
+@click.option('--convert/--no-convert', default=True, help='convert the latest step_*.t7 of plbert_dir, if there is one')
+def main(plbert_dir, model_path, config_path, torchscript, onnx, convert):
+    """
+    Converts the latest PL-BERT training checkpoint of plbert_dir once, load_plbert then reads the
+    converted file until a newer checkpoint shows up. With -m, also traces the PL-BERT of that checkpoint,
+    which does not need the training checkpoints of plbert_dir.
+    """
+    if convert:
+        if osp.isdir(plbert_dir) and latest_checkpoint(plbert_dir) is not None:
+            print('Converted to %s' % convert_plbert(plbert_dir))
+        else:
+            print('No step_*.t7 checkpoint in %s, nothing to convert' % plbert_dir)
+
+    if torchscript is not None or onnx is not None:
+        assert model_path is not None, 'Tracing needs the checkpoint that holds the finetuned PL-BERT (-m)'
+        from inference import InferenceEngine
+        engine = InferenceEngine(config_path, model_path, device='cpu')
+        export_plbert(engine.model.bert, torchscript, onnx)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,45 @@
+#coding:utf-8
+import os
+import os.path as osp
+from collections import OrderedDict
+
+import yaml
+import click
+import torch
+
+from inference import INFERENCE_MODULES, ARTIFACT_FORMAT, load_state, strip_module_prefix
+
+@click.command()
+@click.option('-p', '--config_path', default='Configs/config_darija_ft.yml', type=str)
+@click.option('-m', '--model_path', required=True, type=str, help='second stage or finetuned checkpoint')
+@click.option('-o', '--output_path', required=True, type=str)
+@click.option('--fp16', is_flag=True, help='store the floating point weights in half precision')
+def main(config_path, model_path, output_path, fp16):
+    """Writes an inference only checkpoint: the synthesis modules, the config and the PL-BERT config."""
+    config = yaml.safe_load(open(config_path))
+    plbert_dir = config.get('PLBERT_dir', 'Utils/PLBERT/')
+    plbert_config = yaml.safe_load(open(osp.join(plbert_dir, 'config.yml')))
+
+    params = load_state(model_path)['net']
+    net = OrderedDict()
+    for key in INFERENCE_MODULES:
+        if key not in params:
+            print('%s not in checkpoint, skipped' % key)
+            continue
+        state_dict = strip_module_prefix(params[key])
+        net[key] = OrderedDict((k, v.half() if fp16 and v.is_floating_point() else v)
+                               for k, v in state_dict.items())
+
+    torch.save({
+        'format': ARTIFACT_FORMAT,
+        'config': config,
+        'plbert_config': plbert_config['model_params'],
+        'fp16': fp16,
+        'net': net,
+    }, output_path)
+
+    print('%s: %.1f MB -> %s: %.1f MB' % (model_path, os.path.getsize(model_path) / 2**20,
+                                         output_path, os.path.getsize(output_path) / 2**20))
+
+if __name__=="__main__":
+    main()
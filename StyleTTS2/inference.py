@@ -0,0 +1,371 @@
+#coding:utf-8
+import os
+import os.path as osp
+import time
+from collections import OrderedDict
+
+import yaml
+import click
+import numpy as np
+import torch
+import torch.nn as nn
+import torchaudio
+import librosa
+import soundfile as sf
+from munch import Munch
+
+from models import build_model, freeze_for_inference
+from utils import length_to_mask, recursive_munch
+from text_utils import TextCleaner
+from phonemize import BACKENDS, Phonemizer
+from style_cache import StyleCache, checkpoint_id
+from Utils.PLBERT.util import load_plbert, build_plbert
+from Modules.diffusion.sampler import DiffusionSampler, ADPM2Sampler, DPMpp2MSampler, KarrasSchedule
+
+# modules needed to synthesize, everything else in the training checkpoint is dropped
+INFERENCE_MODULES = ['bert', 'bert_encoder', 'predictor', 'predictor_encoder',
+                     'style_encoder', 'text_encoder', 'decoder', 'diffusion']
+# format tag of the slim checkpoints written by export_model.py
+ARTIFACT_FORMAT = 'styletts2-inference'
+
+to_mel = torchaudio.transforms.MelSpectrogram(
+    n_mels=80, n_fft=2048, win_length=1200, hop_length=300)
+mean, std = -4, 4
+
+SAMPLERS = {
+    'adpm2': ADPM2Sampler,
+    'dpmpp2m': DPMpp2MSampler,
+}
+
+def preprocess(wave):
+    wave_tensor = torch.from_numpy(wave).float()
+    mel_tensor = to_mel(wave_tensor)
+    mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(0)) - mean) / std
+    return mel_tensor
+
+def load_state(path):
+    # memory mapped, only the tensors that end up being used are read from disk
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except RuntimeError:
+        # checkpoints in the legacy (non zip) format cannot be memory mapped
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+def strip_module_prefix(state_dict):
+    # the second stage and finetuning scripts save DataParallel wrapped modules
+    if all(k.startswith('module.') for k in state_dict):
+        state_dict = OrderedDict((k[7:], v) for k, v in state_dict.items())
+    return state_dict
+
+def load_inference_checkpoint(model, params):
+    for key in model:
+        if key not in params:
+            continue
+        # fp16 exports are computed in float32, other tensors are assigned as is and stay memory mapped
+        state_dict = OrderedDict((k, v.float() if v.is_floating_point() else v)
+                                 for k, v in strip_module_prefix(params[key]).items())
+        model[key].load_state_dict(state_dict, strict=False, assign=True)
+        print('%s loaded' % key)
+    return model
+
+def build_sampler(diffusion, name='adpm2'):
+    return DiffusionSampler(
+        diffusion.diffusion,
+        sampler=SAMPLERS[name](),
+        sigma_schedule=KarrasSchedule(sigma_min=0.0001, sigma_max=3.0, rho=9.0), # empirical parameters
+        clamp=False
+    )
+
+class InferenceEngine:
+    """
+    Builds the networks and loads the checkpoint once, then synthesizes any number of utterances.
+
+    Args:
+      config_path (str): training config of the checkpoint, unused for exported checkpoints.
+      model_path (str): second stage or finetuned checkpoint, or the output of export_model.py.
+      phonemizer (callable): maps raw text to the symbols of `TextCleaner`, e.g. a `phonemize.Phonemizer`, text is used as is if None.
+      style_cache_dir (str): where to persist reference styles, they are only cached in memory if None.
+      sampler (str): style diffusion sampler, 'adpm2' (2 evaluations per step) or 'dpmpp2m' (1 per step).
+      freeze (bool): fold weight_norm/spectral_norm and drop dropout, see `freeze_for_inference`.
+      plbert_script (str): TorchScript PL-BERT traced from this checkpoint by convert_plbert.py, replaces `bert`.
+    """
+
+    def __init__(self, config_path, model_path, device=None, phonemizer=None, style_cache_dir=None, sampler='adpm2', freeze=True,
+                 plbert_script=None):
+        state = load_state(model_path)
+        exported = state.get('format') == ARTIFACT_FORMAT
+        # exported checkpoints carry their configs and the finetuned PL-BERT weights
+        self.config = state['config'] if exported else yaml.safe_load(open(config_path))
+        self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model_params = recursive_munch(self.config['model_params'])
+        self.style_dim = self.model_params.style_dim
+        self.multispeaker = self.model_params.multispeaker
+
+        self.phonemizer = phonemizer
+        self.text_cleaner = TextCleaner()
+
+        # the text aligner and the pitch extractor are only used for training
+        if exported:
+            plbert = build_plbert(state['plbert_config'])
+        else:
+            plbert = load_plbert(self.config.get('PLBERT_dir', 'Utils/PLBERT/'))
+        nets = build_model(self.model_params, None, None, plbert)
+        self.model = Munch((key, nets[key]) for key in INFERENCE_MODULES)
+
+        load_inference_checkpoint(self.model, state['net'])
+        del state
+        _ = [self.model[key].eval() for key in self.model]
+        if freeze:
+            freeze_for_inference(self.model)
+        _ = [self.model[key].to(self.device) for key in self.model]
+        if plbert_script is not None:
+            self.model.bert = torch.jit.load(plbert_script, map_location=self.device)
+
+        self.style_cache = StyleCache(style_cache_dir, checkpoint_id(model_path))
+
+        self.sampler = build_sampler(self.model.diffusion, sampler)
+
+    def _token_ids(self, text):
+        ps = text.strip()
+        if self.phonemizer is not None:
+            ps = self.phonemizer(ps)
+        tokens = self.text_cleaner(ps)
+        tokens.insert(0, 0)
+        return tokens
+
+    def tokenize(self, text):
+        return torch.LongTensor(self._token_ids(text)).to(self.device).unsqueeze(0)
+
+    @torch.no_grad()
+    def compute_style(self, path):
+        # a cache hit skips reading, decoding and encoding the reference
+        style = self.style_cache.get(path)
+        if style is None:
+            style = self._compute_style(path).cpu().numpy()
+            self.style_cache.put(path, style)
+        return torch.from_numpy(style).to(self.device)
+
+    def _compute_style(self, path):
+        wave, sr = librosa.load(path, sr=24000)
+        audio, index = librosa.effects.trim(wave, top_db=30)
+        mel_tensor = preprocess(audio).to(self.device)
+
+        ref_s = self.model.style_encoder(mel_tensor.unsqueeze(1))
+        ref_p = self.model.predictor_encoder(mel_tensor.unsqueeze(1))
+
+        return torch.cat([ref_s, ref_p], dim=1)
+
+    def _shift(self, x):
+        # the hifigan decoder was trained on alignments shifted by one frame
+        if self.model_params.decoder.type == "hifigan":
+            x = torch.cat([x[..., :1], x[..., :-1]], dim=-1)
+        return x
+
+    def _sample_style(self, bert_dur, ref_style, noise, alpha, beta, diffusion_steps, embedding_scale, embedding_mask=None):
+        kwargs = {'features': ref_style} if self.multispeaker else {}
+        if embedding_mask is not None:
+            kwargs['embedding_mask'] = embedding_mask
+        s_pred = self.sampler(noise=noise,
+                              embedding=bert_dur,
+                              embedding_scale=embedding_scale,
+                              num_steps=diffusion_steps,
+                              **kwargs).squeeze(1)
+
+        ref = s_pred[:, :self.style_dim]
+        s = s_pred[:, self.style_dim:]
+        if ref_style is not None:
+            ref = alpha * ref + (1 - alpha) * ref_style[:, :self.style_dim]
+            s = beta * s + (1 - beta) * ref_style[:, self.style_dim:]
+        return ref, s
+
+    @staticmethod
+    def _alignment(pred_dur):
+        # hard monotonic alignment [B, T_text, T_frames] from the predicted durations,
+        # durations of padded tokens must be 0
+        frame_end = torch.cumsum(pred_dur, dim=-1)
+        frame_lengths = frame_end[:, -1]
+        frames = torch.arange(int(frame_lengths.max()), device=pred_dur.device)
+        aln = (frames >= (frame_end - pred_dur).unsqueeze(-1)) & (frames < frame_end.unsqueeze(-1))
+        return aln.float(), frame_lengths
+
+    @torch.no_grad()
+    def synthesize(self, text, ref_style=None, alpha=0.3, beta=0.7, diffusion_steps=5, embedding_scale=1, noise=None, trim=50):
+        """
+        Returns the waveform at 24 kHz as a float32 numpy array.
+
+        ref_style is the [1, 2 * style_dim] output of `compute_style`, it is required for
+        multispeaker models and only blended into the sampled style otherwise.
+        """
+        assert ref_style is not None or not self.multispeaker, 'Multispeaker models need a reference style'
+        model = self.model
+
+        tokens = self.tokenize(text)
+        input_lengths = torch.LongTensor([tokens.shape[-1]]).to(self.device)
+        text_mask = length_to_mask(input_lengths).to(self.device)
+
+        t_en = model.text_encoder.inference(tokens)
+        bert_dur = model.bert(tokens, (~text_mask).int())
+        d_en = model.bert_encoder(bert_dur).transpose(-1, -2)
+
+        if noise is None:
+            noise = torch.randn((1, 1, self.style_dim * 2), device=self.device)
+        ref, s = self._sample_style(bert_dur, ref_style, noise, alpha, beta, diffusion_steps, embedding_scale)
+
+        d = model.predictor.text_encoder.inference(d_en, s)
+        x, _ = model.predictor.lstm(d)
+        duration = model.predictor.duration_proj(x)
+        duration = torch.sigmoid(duration).sum(axis=-1)
+        pred_dur = torch.round(duration).clamp(min=1).long()
+
+        pred_aln_trg, _ = self._alignment(pred_dur)
+
+        # encode prosody
+        en = self._shift(d.transpose(-1, -2) @ pred_aln_trg)
+        F0_pred, N_pred = model.predictor.F0Ntrain(en, s)
+
+        asr = self._shift(t_en @ pred_aln_trg)
+        out = model.decoder(asr, F0_pred, N_pred, ref)
+
+        wav = out.squeeze().cpu().numpy()
+        return wav[..., :-trim] if trim else wav # weird pulse at the end of the model
+
+    @staticmethod
+    def _buckets(lengths, max_tokens):
+        # longest first, a bucket is closed once its padded size would exceed the budget
+        order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+        buckets, bucket = [], []
+        for i in order:
+            if bucket and lengths[bucket[0]] * (len(bucket) + 1) > max_tokens:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    @torch.no_grad()
+    def synthesize_batch(self, texts, styles=None, alpha=0.3, beta=0.7, diffusion_steps=5, embedding_scale=1, max_tokens=2048, trim=50):
+        """
+        Synthesizes many texts with one forward pass per length bucket, returns the waveforms in input order.
+
+        styles is either None, a single [1, 2 * style_dim] style shared by every text or one style per text.
+        max_tokens bounds the padded number of phoneme tokens of a bucket.
+        """
+        assert styles is not None or not self.multispeaker, 'Multispeaker models need reference styles'
+        if hasattr(self.phonemizer, 'phonemize'):
+            # phonemize in one batch, the calls of _token_ids then hit the phonemizer cache
+            self.phonemizer.phonemize([text.strip() for text in texts])
+        tokens = [self._token_ids(text) for text in texts]
+
+        if styles is not None:
+            if torch.is_tensor(styles) and styles.dim() == 2 and styles.shape[0] == 1:
+                styles = styles.expand(len(texts), -1)
+            elif not torch.is_tensor(styles):
+                styles = torch.cat(list(styles), dim=0)
+            assert styles.shape[0] == len(texts), 'Need one style per text'
+
+        wavs = [None] * len(texts)
+        for bucket in self._buckets([len(t) for t in tokens], max_tokens):
+            ref_style = styles[bucket].to(self.device) if styles is not None else None
+            outs = self._synthesize_bucket([tokens[i] for i in bucket], ref_style, alpha, beta,
+                                           diffusion_steps, embedding_scale, trim)
+            for i, wav in zip(bucket, outs):
+                wavs[i] = wav
+        return wavs
+
+    def _synthesize_bucket(self, tokens, ref_style, alpha, beta, diffusion_steps, embedding_scale, trim):
+        model = self.model
+        batch_size = len(tokens)
+        lengths = [len(t) for t in tokens]
+
+        texts = torch.zeros((batch_size, max(lengths)), dtype=torch.long)
+        for i, t in enumerate(tokens):
+            texts[i, :len(t)] = torch.LongTensor(t)
+        texts = texts.to(self.device)
+        input_lengths = torch.LongTensor(lengths).to(self.device)
+        text_mask = length_to_mask(input_lengths).to(self.device)
+
+        t_en = model.text_encoder(texts, input_lengths, text_mask)
+        bert_dur = model.bert(texts, (~text_mask).int())
+        d_en = model.bert_encoder(bert_dur).transpose(-1, -2)
+
+        noise = torch.randn((batch_size, 1, self.style_dim * 2), device=self.device)
+        ref, s = self._sample_style(bert_dur, ref_style, noise, alpha, beta, diffusion_steps, embedding_scale,
+                                    embedding_mask=~text_mask)
+
+        d = model.predictor.text_encoder(d_en, s, input_lengths, text_mask)
+        x = nn.utils.rnn.pack_padded_sequence(d, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+        x, _ = model.predictor.lstm(x)
+        x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=d.shape[1])
+        duration = model.predictor.duration_proj(x)
+        duration = torch.sigmoid(duration).sum(axis=-1)
+        pred_dur = torch.round(duration).clamp(min=1).long().masked_fill(text_mask, 0)
+
+        pred_aln_trg, frame_lengths = self._alignment(pred_dur)
+        frame_mask = (~length_to_mask(frame_lengths)).unsqueeze(1).float().to(self.device)
+
+        # encode prosody
+        en = self._shift(d.transpose(-1, -2) @ pred_aln_trg)
+        F0_pred, N_pred = model.predictor.F0Ntrain(en, s, frame_mask)
+
+        asr = self._shift(t_en @ pred_aln_trg)
+        out = model.decoder(asr, F0_pred, N_pred, ref, frame_mask)
+
+        # split the padded output back by the number of frames of each utterance
+        hop = out.shape[-1] // asr.shape[-1]
+        out = out.squeeze(1).cpu().numpy()
+        wavs = []
+        for i, n in enumerate(frame_lengths.tolist()):
+            wav = out[i, :n * hop]
+            wavs.append(wav[..., :-trim] if trim else wav)
+        return wavs
+
+
+def read_texts(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [l.strip() for l in f.readlines() if l.strip()]
+
+@click.command()
+@click.option('-p', '--config_path', default='Configs/config_darija_ft.yml', type=str)
+@click.option('-m', '--model_path', required=True, type=str)
+@click.option('-t', '--text_path', required=True, type=str, help='one utterance per line')
+@click.option('-r', '--reference', default=None, type=str, help='reference wav, required for multispeaker models')
+@click.option('-o', '--output_dir', default='outputs', type=str)
+@click.option('--style_cache_dir', default=None, type=str, help='persist reference styles across runs')
+@click.option('--plbert_script', default=None, type=str, help='TorchScript PL-BERT from convert_plbert.py')
+@click.option('--diffusion_steps', default=5, type=int)
+@click.option('--sampler', default='adpm2', type=click.Choice(list(SAMPLERS)))
+@click.option('--embedding_scale', default=1.0, type=float)
+@click.option('--alpha', default=0.3, type=float)
+@click.option('--beta', default=0.7, type=float)
+@click.option('--phonemizer', 'phonemizer_backend', default=None, type=click.Choice(sorted(BACKENDS)), help='phonemize the texts, they are used as is by default')
+@click.option('--language', default='ar', type=str, help='language of the phonemizer')
+@click.option('--phoneme_cache', default=None, type=str, help='sqlite phoneme cache, e.g. the one of preprocess.py phonemize')
+@click.option('--max_tokens', default=0, type=int, help='synthesize in length buckets of at most this many padded tokens, 0 for one utterance at a time')
+def main(config_path, model_path, text_path, reference, output_dir, diffusion_steps, embedding_scale, alpha, beta, max_tokens, style_cache_dir, sampler, plbert_script,
+         phonemizer_backend, language, phoneme_cache):
+    phonemizer = Phonemizer(phonemizer_backend, language, cache_path=phoneme_cache) if phonemizer_backend else None
+    engine = InferenceEngine(config_path, model_path, phonemizer=phonemizer, style_cache_dir=style_cache_dir, sampler=sampler,
+                             plbert_script=plbert_script)
+    ref_style = engine.compute_style(reference) if reference is not None else None
+
+    os.makedirs(output_dir, exist_ok=True)
+    texts = read_texts(text_path)
+
+    start = time.time()
+    total_len = 0
+    if max_tokens > 0:
+        wavs = engine.synthesize_batch(texts, ref_style, alpha=alpha, beta=beta, diffusion_steps=diffusion_steps,
+                                       embedding_scale=embedding_scale, max_tokens=max_tokens)
+    else:
+        wavs = (engine.synthesize(text, ref_style, alpha=alpha, beta=beta,
+                                  diffusion_steps=diffusion_steps, embedding_scale=embedding_scale) for text in texts)
+    for i, wav in enumerate(wavs):
+        sf.write(osp.join(output_dir, '%05d.wav' % i), wav, 24000)
+        total_len += len(wav)
+
+    elapsed = time.time() - start
+    print('Synthesized %d utterances in %.2fs, RTF = %.5f' % (len(texts), elapsed, elapsed / max(total_len / 24000, 1e-6)))
+
+if __name__=="__main__":
+    main()
@@ -94,6 +94,34 @@ class MultiResolutionSTFTLoss(torch.nn.Module):
         return sc_loss
     
     
+def duration_loss(d, d_gt, input_lengths):
+    """
+    Duration losses of the prosody predictor for a padded batch, d are the [B, T, max_dur] logits and
+    d_gt the [B, T] durations. The L1 loss of the predicted durations leaves out the first and last
+    token, the BCE is against the cumulative duration target (1 for the first d_gt frames). Both are
+    averaged over every utterance and then over the batch. Returns (loss_dur, loss_ce).
+    """
+    lengths = input_lengths.to(d.device)[:, None]
+    d_gt = d_gt.long()
+    tokens = torch.arange(d.shape[1], device=d.device)[None, :]
+    valid = tokens < lengths
+    inner = (tokens >= 1) & (tokens < lengths - 1)
+
+    s2s_trg = (torch.arange(d.shape[2], device=d.device)[None, None, :] < d_gt[..., None]).to(d.dtype)
+    dur_pred = torch.sigmoid(d).sum(dim=-1)
+    loss_dur = (dur_pred - d_gt).abs().masked_fill(~inner, 0).sum(dim=-1) / inner.sum(dim=-1)
+    loss_ce = F.binary_cross_entropy_with_logits(d, s2s_trg, reduction='none').sum(dim=-1)
+    loss_ce = loss_ce.masked_fill(~valid, 0).sum(dim=-1) / (lengths.squeeze(1) * d.shape[2])
+    return loss_dur.mean(), loss_ce.mean()
+
+def s2s_loss(s2s_pred, texts, input_lengths):
+    """Token cross entropy of the aligner decoder, averaged over every utterance and then over the batch."""
+    length = min(s2s_pred.shape[1], texts.shape[1])
+    lengths = input_lengths.to(s2s_pred.device)
+    ce = F.cross_entropy(s2s_pred[:, :length].transpose(1, 2), texts[:, :length], reduction='none')
+    valid = torch.arange(length, device=s2s_pred.device)[None, :] < lengths[:, None]
+    return (ce.masked_fill(~valid, 0).sum(dim=-1) / lengths).mean()
+
 def feature_loss(fmap_r, fmap_g):
     loss = 0
     for dr, dg in zip(fmap_r, fmap_g):
@@ -2,6 +2,8 @@
 import os
 import os.path as osp
 import time
+import json
+import hashlib
 import random
 import numpy as np
 import random
@@ -13,36 +15,13 @@ from torch import nn
 import torch.nn.functional as F
 import torchaudio
 from torch.utils.data import DataLoader
+from typing import NamedTuple, Optional
 
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-import pandas as pd
-
-_pad = "$"
-_punctuation = ';:,.!?¡¿—…"«»“” '
-_letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
-_letters_ipa = "ɑɐɒæɓʙβɔɕçɗɖðʤəɘɚɛɜɝɞɟʄɡɠɢʛɦɧħɥʜɨɪʝɭɬɫɮʟɱɯɰŋɳɲɴøɵɸθœɶʘɹɺɾɻʀʁɽʂʃʈʧʉʊʋⱱʌɣɤʍχʎʏʑʐʒʔʡʕʢǀǁǂǃˈˌːˑʼʴʰʱʲʷˠˤ˞↓↑→↗↘'̩'ᵻ"
-
-# Export all symbols:
-symbols = [_pad] + list(_punctuation) + list(_letters) + list(_letters_ipa)
-
-dicts = {}
-for i in range(len((symbols))):
-    dicts[symbols[i]] = i
-
-class TextCleaner:
-    def __init__(self, dummy=None):
-        self.word_index_dictionary = dicts
-    def __call__(self, text):
-        indexes = []
-        for char in text:
-            try:
-                indexes.append(self.word_index_dictionary[char])
-            except KeyError:
-                print(text)
-        return indexes
+from text_utils import TextCleaner
 
 np.random.seed(1)
 random.seed(1)
@@ -57,14 +36,143 @@ MEL_PARAMS = {
 
 to_mel = torchaudio.transforms.MelSpectrogram(
     n_mels=80, n_fft=2048, win_length=1200, hop_length=300)
+# for windows read with their STFT context, see `FilePathDataset._load_data`
+to_mel_window = torchaudio.transforms.MelSpectrogram(
+    n_mels=80, n_fft=2048, win_length=1200, hop_length=300, center=False)
 mean, std = -4, 4
 
-def preprocess(wave):
+def preprocess(wave, center=True):
     wave_tensor = torch.from_numpy(wave).float()
-    mel_tensor = to_mel(wave_tensor)
+    mel_tensor = (to_mel if center else to_mel_window)(wave_tensor)
     mel_tensor = (torch.log(1e-5 + mel_tensor.unsqueeze(0)) - mean) / std
     return mel_tensor
 
+RESAMPLED_MANIFEST = 'manifest.json'
+SHARD_INDEX = 'index.npz'
+
+def load_wave(path, sr=24000, resample=True):
+    wave, file_sr = sf.read(path, dtype='float32')
+    if wave.ndim == 2:
+        # mix down to mono
+        wave = wave.mean(axis=1)
+    if file_sr != sr:
+        if not resample:
+            raise ValueError('%s is %d Hz, expected %d Hz' % (path, file_sr, sr))
+        wave = librosa.resample(wave, orig_sr=file_sr, target_sr=sr)
+        print(path, file_sr)
+    return wave
+
+def load_resampled_manifest(resampled_dir, sr=24000):
+    """Manifest written by `python preprocess.py resample`, checked against the sampling rate."""
+    manifest_path = osp.join(resampled_dir, RESAMPLED_MANIFEST)
+    if not osp.isfile(manifest_path):
+        raise ValueError('No %s in %s, run `python preprocess.py resample` first' % (RESAMPLED_MANIFEST, resampled_dir))
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest['sr'] != sr:
+        raise ValueError('%s is resampled to %d Hz, expected %d Hz' % (resampled_dir, manifest['sr'], sr))
+    return manifest
+
+def tokenize_lines(texts, text_cleaner, cache_dir=None):
+    """
+    Token ids of every text padded with 0 on both sides, as a flat int64 array and the offsets of
+    the texts in it. With cache_dir they are stored once per list of texts and symbol table.
+    """
+    if cache_dir is not None:
+        ident = json.dumps([texts, sorted(text_cleaner.word_index_dictionary.items())], ensure_ascii=False)
+        cache_path = osp.join(cache_dir, hashlib.sha1(ident.encode('utf-8')).hexdigest() + '.tokens.npz')
+        if osp.isfile(cache_path):
+            cached = np.load(cache_path)
+            return cached['tokens'], cached['offsets']
+
+    tokens, offsets = [], [0]
+    for text in texts:
+        tokens.append(np.pad(text_cleaner.encode(text), 1))
+        offsets.append(offsets[-1] + len(tokens[-1]))
+    tokens = np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int64)
+    offsets = np.array(offsets, dtype=np.int64)
+    report = text_cleaner.report()
+    if report is not None:
+        print(report)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cache_path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, tokens=tokens, offsets=offsets)
+        os.replace(tmp, cache_path)
+    return tokens, offsets
+
+def pad_wave(wave):
+    return np.concatenate([np.zeros([5000], dtype=np.float32), wave, np.zeros([5000], dtype=np.float32)], axis=0)
+
+def wave_to_float(waves):
+    """Float waves of a batch, the int16 waves of `Collater(wave_dtype='int16')` are scaled on their device."""
+    if waves.dtype == torch.int16:
+        return waves.float() / 32767
+    return waves
+
+class MelCache:
+    """
+    Waves and log-mels of the utterances, stored once as a pair of memory mapped .npy files.
+
+    Entries are keyed by the wav path, its size and mtime and the feature parameters, so edited
+    files or new mel parameters are recomputed instead of served stale. Missing entries are
+    computed and written on first access, or ahead of time with `python preprocess.py mels`.
+
+    Args:
+      cache_dir (str): directory of the cache, shared by all data loader workers.
+      sr (int): sampling rate of the waves.
+      wave_dtype (str): 'float32' or 'int16', int16 halves the size of the stored waves.
+    """
+
+    def __init__(self, cache_dir, sr=24000, wave_dtype='float32'):
+        assert wave_dtype in ['float32', 'int16'], wave_dtype
+        self.cache_dir = cache_dir
+        self.sr = sr
+        self.wave_dtype = wave_dtype
+        self.params = json.dumps([SPECT_PARAMS, MEL_PARAMS, mean, std, sr, wave_dtype], sort_keys=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path):
+        stat = os.stat(path)
+        ident = '%s|%d|%d|%s' % (osp.abspath(path), stat.st_size, stat.st_mtime_ns, self.params)
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def _files(self, key):
+        prefix = osp.join(self.cache_dir, key[:2], key)
+        return prefix + '.wav.npy', prefix + '.mel.npy'
+
+    def get(self, path):
+        """Returns the unpadded wave and the log-mel of the padded wave, see `pad_wave`."""
+        wave_file, mel_file = self._files(self.key(path))
+        # the mel is written last, so its presence means the entry is complete
+        if osp.isfile(mel_file):
+            wave = np.load(wave_file, mmap_mode='r')
+            mel = np.load(mel_file, mmap_mode='r')
+            if wave.dtype == np.int16:
+                wave = wave.astype(np.float32) / 32767
+            return wave, mel
+
+        wave = load_wave(path, self.sr)
+        mel = preprocess(pad_wave(wave)).squeeze().numpy()
+        if self.wave_dtype == 'int16':
+            stored = (np.clip(wave, -1, 1) * 32767).astype(np.int16)
+            wave = stored.astype(np.float32) / 32767
+        else:
+            stored = wave.astype(np.float32)
+        os.makedirs(osp.dirname(mel_file), exist_ok=True)
+        self._save(wave_file, stored)
+        self._save(mel_file, mel)
+        return wave, mel
+
+    def _save(self, path, array):
+        # write then rename so concurrent workers never read a partial file
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+
 class FilePathDataset(torch.utils.data.Dataset):
     def __init__(self,
                  data_list,
@@ -74,6 +182,11 @@ class FilePathDataset(torch.utils.data.Dataset):
                  validation=False,
                  OOD_data="Data/OOD_texts.txt",
                  min_length=50,
+                 mel_cache_dir=None,
+                 wave_dtype='float32',
+                 distinct_reference=False,
+                 resampled_dir=None,
+                 token_cache_dir=None,
                  ):
 
         spect_params = SPECT_PARAMS
@@ -83,8 +196,20 @@ class FilePathDataset(torch.utils.data.Dataset):
         self.data_list = [data if len(data) == 3 else (*data, 0) for data in _data_list]
         self.text_cleaner = TextCleaner()
         self.sr = sr
-
-        self.df = pd.DataFrame(self.data_list)
+        # token ids of every line, computed once instead of in every __getitem__
+        self.tokens, self.token_offsets = tokenize_lines([data[1] for data in self.data_list], self.text_cleaner, token_cache_dir)
+
+        # speaker -> indexes of its utterances, and the position of every utterance in that array,
+        # so that references are sampled in constant time
+        speaker_indexes = {}
+        self.speaker_position = np.zeros(len(self.data_list), dtype=np.int64)
+        for i, data in enumerate(self.data_list):
+            indexes = speaker_indexes.setdefault(int(data[2]), [])
+            self.speaker_position[i] = len(indexes)
+            indexes.append(i)
+        self.speaker_indexes = {k: np.array(v) for k, v in speaker_indexes.items()}
+        # draw the reference among the other utterances of the speaker when it has any
+        self.distinct_reference = distinct_reference
 
         self.to_melspec = torchaudio.transforms.MelSpectrogram(**MEL_PARAMS)
 
@@ -96,69 +221,119 @@ class FilePathDataset(torch.utils.data.Dataset):
         with open(OOD_data, 'r', encoding='utf-8') as f:
             tl = f.readlines()
         idx = 1 if '.wav' in tl[0].split('|')[0] else 0
-        self.ptexts = [t.split('|')[idx] for t in tl]
+        # the OOD texts long enough to be drawn, tokenized once into a flat array and the offsets of the
+        # lines, which the forked workers share
+        ptexts = [t.split('|')[idx] for t in tl]
+        ptexts = [ps.rstrip('\n') for ps in ptexts if len(ps) >= min_length]
+        if len(ptexts) == 0:
+            raise ValueError('No line of %s has at least %d characters (min_length)' % (OOD_data, min_length))
+        self.ood_tokens, self.ood_offsets = tokenize_lines(ptexts, self.text_cleaner, token_cache_dir)
         
         self.root_path = root_path
+        # read the audio from the output of `preprocess.py resample` instead of resampling it at every load
+        self.resampled_dir = resampled_dir
+        if resampled_dir is not None:
+            files = load_resampled_manifest(resampled_dir, sr)['files']
+            missing = [data[0] for data in self.data_list if data[0] not in files]
+            if missing:
+                raise ValueError('%d files of the list are missing from %s, e.g. %s, run `python preprocess.py resample`'
+                                 % (len(missing), resampled_dir, missing[0]))
+        self.mel_cache = MelCache(mel_cache_dir, sr=24000, wave_dtype=wave_dtype) if mel_cache_dir else None
 
     def __len__(self):
         return len(self.data_list)
 
+    def mel_lengths(self):
+        """Mel frames of every utterance, computed from the wav headers without decoding the audio."""
+        lengths = np.zeros(len(self.data_list), dtype=np.int64)
+        for i, data in enumerate(self.data_list):
+            info = sf.info(self._audio_path(data[0]))
+            samples = int(info.frames * self.sr / info.samplerate) + 10000 # see `pad_wave`
+            lengths[i] = samples // SPECT_PARAMS['hop_length'] + 1
+        return lengths
+
     def __getitem__(self, idx):        
         data = self.data_list[idx]
         path = data[0]
         
-        wave, text_tensor, speaker_id = self._load_tensor(data)
-        
-        mel_tensor = preprocess(wave).squeeze()
+        wave, mel_tensor, text_tensor, speaker_id = self._load_tensor(idx)
         
         acoustic_feature = mel_tensor.squeeze()
         length_feature = acoustic_feature.size(1)
         acoustic_feature = acoustic_feature[:, :(length_feature - length_feature % 2)]
         
         # get reference sample
-        ref_data = (self.df[self.df[2] == str(speaker_id)]).sample(n=1).iloc[0].tolist()
-        ref_mel_tensor, ref_label = self._load_data(ref_data[:3])
+        ref_mel_tensor, ref_label = self._load_data(self._sample_reference(idx, speaker_id))
         
         # get OOD text
-        
-        ps = ""
-        
-        while len(ps) < self.min_length:
-            rand_idx = np.random.randint(0, len(self.ptexts) - 1)
-            ps = self.ptexts[rand_idx]
-            
-            text = self.text_cleaner(ps)
-            text.insert(0, 0)
-            text.append(0)
-
-            ref_text = torch.LongTensor(text)
+        rand_idx = np.random.randint(len(self.ood_offsets) - 1)
+        ref_text = torch.from_numpy(self.ood_tokens[self.ood_offsets[rand_idx]:self.ood_offsets[rand_idx + 1]])
         
         return speaker_id, acoustic_feature, text_tensor, ref_text, ref_mel_tensor, ref_label, path, wave
 
-    def _load_tensor(self, data):
-        wave_path, text, speaker_id = data
+    def _sample_reference(self, idx, speaker_id):
+        indexes = self.speaker_indexes[speaker_id]
+        if not self.distinct_reference or len(indexes) == 1:
+            return indexes[np.random.randint(len(indexes))]
+        # skip over the target itself
+        i = np.random.randint(len(indexes) - 1)
+        if i >= self.speaker_position[idx]:
+            i += 1
+        return indexes[i]
+
+    def _load_tensor(self, idx):
+        wave_path, _, speaker_id = self.data_list[idx]
         speaker_id = int(speaker_id)
-        wave, sr = sf.read(osp.join(self.root_path, wave_path))
-        if wave.shape[-1] == 2:
-            wave = wave[:, 0].squeeze()
-        if sr != 24000:
-            wave = librosa.resample(wave, orig_sr=sr, target_sr=24000)
-            print(wave_path, sr)
-            
-        wave = np.concatenate([np.zeros([5000]), wave, np.zeros([5000])], axis=0)
+        wave, mel_tensor = self._load_audio(self._audio_path(wave_path))
         
-        text = self.text_cleaner(text)
-        
-        text.insert(0, 0)
-        text.append(0)
-        
-        text = torch.LongTensor(text)
-
-        return wave, text, speaker_id
-
-    def _load_data(self, data):
-        wave, text_tensor, speaker_id = self._load_tensor(data)
-        mel_tensor = preprocess(wave).squeeze()
+        text = torch.from_numpy(self.tokens[self.token_offsets[idx]:self.token_offsets[idx + 1]])
+
+        return wave, mel_tensor, text, speaker_id
+
+    def _audio_path(self, wave_path):
+        if self.resampled_dir is not None:
+            return osp.join(self.resampled_dir, wave_path)
+        return osp.join(self.root_path, wave_path)
+
+    def _load_audio(self, path):
+        # padded wave and its log-mel
+        if self.mel_cache is None:
+            wave = pad_wave(load_wave(path, self.sr, resample=(self.resampled_dir is None)))
+            return wave, preprocess(wave).squeeze()
+        wave, mel = self.mel_cache.get(path)
+        return pad_wave(wave), torch.from_numpy(np.array(mel, dtype=np.float32))
+
+    def _num_samples(self, wave_path):
+        # length without decoding, None when the file has to be resampled
+        info = sf.info(self._audio_path(wave_path))
+        return info.frames if info.samplerate == self.sr else None
+
+    def _read_span(self, wave_path, start, stop):
+        # samples [start, stop) of the unpadded wave, zero filled outside of it
+        with sf.SoundFile(self._audio_path(wave_path)) as f:
+            begin, end = max(start, 0), min(stop, f.frames)
+            f.seek(begin)
+            wave = f.read(end - begin, dtype='float32', always_2d=True).mean(axis=1)
+        return np.pad(wave, (begin - start, stop - end))
+
+    def _load_data(self, idx):
+        data = self.data_list[idx]
+        # the random window of a long reference is read on its own instead of the whole file
+        num_samples = self._num_samples(data[0]) if self.mel_cache is None else None
+        if num_samples is not None:
+            hop, n_fft = SPECT_PARAMS['hop_length'], SPECT_PARAMS['n_fft']
+            mel_length = (num_samples + 10000) // hop + 1 # see `pad_wave`
+            if mel_length > self.max_mel_length:
+                random_start = np.random.randint(0, mel_length - self.max_mel_length)
+                # frame i is centered on sample i * hop of the padded wave, which starts 5000 samples early,
+                # and sees n_fft // 2 samples on each side. The centered STFT pads reflect the zeros of
+                # `pad_wave`, so zero filling gives the same frames as cropping the full mel.
+                start = random_start * hop - n_fft // 2 - 5000
+                stop = start + (self.max_mel_length - 1) * hop + n_fft
+                mel_tensor = preprocess(self._read_span(data[0], start, stop), center=False).squeeze()
+                return mel_tensor, int(data[2])
+
+        wave, mel_tensor, text_tensor, speaker_id = self._load_tensor(idx)
 
         mel_length = mel_tensor.size(1)
         if mel_length > self.max_mel_length:
@@ -168,67 +343,261 @@ class FilePathDataset(torch.utils.data.Dataset):
         return mel_tensor, speaker_id
 
 
+class ShardDataset(FilePathDataset):
+    """
+    `FilePathDataset` reading the waves from the shards written by `python preprocess.py shards`.
+
+    `root_path` is the shard directory: a few shard_*.bin files holding the waves back to back and
+    an index.npz with the path, shard, offset and length of every wave. Only the audio comes from
+    the shards, the texts and speakers come from the list lines like in `FilePathDataset`, so a
+    wave listed several times keeps the labels of each line. The shards are memory mapped lazily
+    in every worker, so the workers share the page cache and a wave is a slice of the map.
+    The mel cache is not used, the mels are computed from the mapped waves.
+    """
+
+    def __init__(self, data_list, root_path, **kwargs):
+        super().__init__(data_list, root_path, **kwargs)
+        self.mel_cache = None
+
+        index = np.load(osp.join(root_path, SHARD_INDEX))
+        if int(index['sr']) != self.sr:
+            raise ValueError('%s is sampled at %d Hz, expected %d Hz' % (root_path, int(index['sr']), self.sr))
+        self.wave_dtype = str(index['wave_dtype'])
+        self.shard, self.offset, self.length = index['shard'], index['offset'], index['length']
+        self.rows = {path: i for i, path in enumerate(index['path'].tolist())}
+        missing = [data[0] for data in self.data_list if data[0] not in self.rows]
+        if missing:
+            raise ValueError('%d files of the list are missing from %s, e.g. %s' % (len(missing), root_path, missing[0]))
+        self._shards = None
+
+    def mel_lengths(self):
+        rows = np.array([self.rows[data[0]] for data in self.data_list])
+        return (self.length[rows] + 10000) // SPECT_PARAMS['hop_length'] + 1
+
+    def _wave(self, row, start=0, stop=None):
+        if self._shards is None:
+            dtype = np.int16 if self.wave_dtype == 'int16' else np.float32
+            self._shards = [np.memmap(osp.join(self.root_path, 'shard_%04d.bin' % i), dtype=dtype, mode='r')
+                            for i in range(int(self.shard.max()) + 1)]
+        stop = self.length[row] if stop is None else stop
+        wave = self._shards[self.shard[row]][self.offset[row] + start:self.offset[row] + stop]
+        if self.wave_dtype == 'int16':
+            return wave.astype(np.float32) / 32767
+        return wave
+
+    def _num_samples(self, wave_path):
+        return int(self.length[self.rows[wave_path]])
+
+    def _read_span(self, wave_path, start, stop):
+        row = self.rows[wave_path]
+        begin, end = max(start, 0), min(stop, int(self.length[row]))
+        return np.pad(self._wave(row, begin, end), (begin - start, stop - end))
+
+    def _load_tensor(self, idx):
+        # the audio from the shards, the text and speaker of the list line
+        wave_path, _, speaker_id = self.data_list[idx]
+        wave = pad_wave(self._wave(self.rows[wave_path]))
+        mel_tensor = preprocess(wave).squeeze()
+        text = torch.from_numpy(self.tokens[self.token_offsets[idx]:self.token_offsets[idx + 1]])
+        return wave, mel_tensor, text, int(speaker_id)
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches utterances of similar length, so that little is padded or cropped away in a batch.
+
+    The utterances are sorted by length and cut into `num_buckets` buckets of equal size. Every
+    epoch the buckets are shuffled internally, split into batches and the batches are shuffled.
+    With `max_frames` the batches take as many utterances as fit in that many padded frames,
+    up to `batch_size`. The order only depends on `seed` and the epoch, which advances at every
+    iteration unless it is set with `set_epoch`.
+
+    Args:
+      lengths (array): length of every utterance, e.g. `FilePathDataset.mel_lengths()`.
+      batch_size (int): size of the batches, the maximum size with `max_frames`.
+      num_buckets (int): number of length buckets.
+      max_frames (int): budget of padded frames (longest length x size) of a batch.
+      drop_last (bool): drop the batches with fewer than `batch_size` utterances, or fewer than
+        2 with `max_frames`.
+      seed (int): seed of the shuffling.
+    """
+
+    def __init__(self, lengths, batch_size, num_buckets=10, max_frames=None, shuffle=True, drop_last=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_buckets = max(1, min(num_buckets, len(self.lengths)))
+        self.max_frames = max_frames
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = np.argsort(self.lengths, kind='stable')
+        batches = []
+        for bucket in np.array_split(order, self.num_buckets):
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            batches.extend(self._split(bucket))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def _split(self, bucket):
+        if self.max_frames is None:
+            batches = [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+            min_size = self.batch_size
+        else:
+            batches, start, longest = [], 0, 0
+            for i, idx in enumerate(bucket):
+                longest_with = max(longest, self.lengths[idx])
+                size = i - start + 1
+                if i > start and (size > self.batch_size or longest_with * size > self.max_frames):
+                    batches.append(bucket[start:i])
+                    start, longest_with = i, self.lengths[idx]
+                longest = longest_with
+            batches.append(bucket[start:])
+            min_size = 2
+        if self.drop_last:
+            batches = [b for b in batches if len(b) >= min_size]
+        return [b.tolist() for b in batches]
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches())
+
+class Batch(NamedTuple):
+    """A collated batch, every field but pinned is a tensor with the utterances sorted by decreasing mel length."""
+    waves: torch.Tensor # [B, samples], float32 or int16, see `wave_to_float`
+    texts: torch.Tensor
+    input_lengths: torch.Tensor
+    ref_texts: torch.Tensor
+    ref_lengths: torch.Tensor
+    mels: torch.Tensor
+    output_lengths: torch.Tensor
+    ref_mels: torch.Tensor
+    wave_lengths: torch.Tensor
+    pinned: Optional['PinnedSlot'] = None # the ring slot holding the fields, see `Collater`
+
+    def to(self, device, non_blocking=True):
+        moved = Batch(*[t.to(device, non_blocking=non_blocking) for t in self[:-1]])
+        if self.pinned is not None:
+            self.pinned.record()
+        return moved
+
+class PinnedSlot:
+    """
+    Pinned buffers of one batch of the `Collater` ring, and the CUDA event recorded by `Batch.to`
+    after their host to device copy. The slot is only written again once that copy is done.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.event = None
+
+    def record(self):
+        self.event = torch.cuda.Event()
+        self.event.record()
+
 class Collater(object):
     """
+    Pads the items of a batch into a `Batch`. Each field is padded with one masked copy of the
+    concatenated items instead of a copy per item.
+
+    With pin_buffers the fields are written into pinned buffers, reused in a ring of num_buffers
+    batches and only grown when a batch needs more room, so the host to device copies are
+    asynchronous and the DataLoader needs no pin_memory pass. A slot is reused once the copy of
+    `Batch.to` from it is done. The host fields of a moved batch are then overwritten, a batch
+    that is never moved keeps its buffers and the slot gets new ones. Pinned buffers can only be
+    used in the main process (num_workers=0), a worker process cannot hand out reused memory.
+
     Args:
       adaptive_batch_size (bool): if true, decrease batch size when long data comes.
+      wave_dtype (str): dtype of the padded waves, 'float32' or 'int16' which halves their transfer,
+        see `wave_to_float`.
+      pin_buffers (bool): write the batches into a ring of pinned buffers.
+      num_buffers (int): size of the ring, a moved batch is overwritten num_buffers batches later.
     """
 
-    def __init__(self, return_wave=False):
+    def __init__(self, return_wave=False, wave_dtype='float32', pin_buffers=False, num_buffers=3):
+        assert wave_dtype in ['float32', 'int16'], wave_dtype
         self.text_pad_index = 0
         self.min_mel_length = 192
         self.max_mel_length = 192
         self.return_wave = return_wave
-        
+        self.wave_dtype = torch.int16 if wave_dtype == 'int16' else torch.float32
+        self.pin_buffers = pin_buffers
+        self.num_buffers = num_buffers
+        self._slots = [PinnedSlot() for _ in range(num_buffers)] if pin_buffers else None
+        self._slot = 0
+
+    def _next_slot(self):
+        slot = self._slots[self._slot]
+        if slot.event is None:
+            # never moved to the device, the batch may still be in use on the host
+            slot = self._slots[self._slot] = PinnedSlot()
+        else:
+            slot.event.synchronize()
+            slot.event = None
+        self._slot = (self._slot + 1) % self.num_buffers
+        return slot
+
+    def _zeros(self, slot, name, shape, dtype):
+        if slot is None:
+            return torch.zeros(shape, dtype=dtype)
+        # a flat buffer per field and slot, viewed as the leading elements so that the batch is contiguous
+        numel = int(np.prod(shape))
+        buffer = slot.buffers.get(name)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(int(numel * 1.25), dtype=dtype).pin_memory()
+            slot.buffers[name] = buffer
+        return buffer[:numel].view(shape).zero_()
+
+    def _pad(self, slot, name, seqs, max_length, dtype, channels=None):
+        # seqs are [length] or [channels, length], padded to [B, max_length] or [B, channels, max_length]
+        # in a single indexed copy
+        lengths = torch.tensor([seq.shape[-1] for seq in seqs])
+        mask = torch.arange(max_length)[None, :] < lengths[:, None]
+        if channels is None:
+            out = self._zeros(slot, name, (len(seqs), max_length), dtype)
+            out[mask] = torch.cat(seqs).to(dtype)
+        else:
+            out = self._zeros(slot, name, (len(seqs), channels, max_length), dtype)
+            out.transpose(1, 2)[mask] = torch.cat(seqs, dim=-1).T.to(dtype)
+        return out, lengths
 
     def __call__(self, batch):
         # batch[0] = wave, mel, text, f0, speakerid
-        batch_size = len(batch)
-
         # sort by mel length
-        lengths = [b[1].shape[1] for b in batch]
-        batch_indexes = np.argsort(lengths)[::-1]
-        batch = [batch[bid] for bid in batch_indexes]
+        batch = sorted(batch, key=lambda b: b[1].shape[1], reverse=True)
 
+        slot = self._next_slot() if self.pin_buffers else None
         nmels = batch[0][1].size(0)
-        max_mel_length = max([b[1].shape[1] for b in batch])
-        max_text_length = max([b[2].shape[0] for b in batch])
-        max_rtext_length = max([b[3].shape[0] for b in batch])
-
-        labels = torch.zeros((batch_size)).long()
-        mels = torch.zeros((batch_size, nmels, max_mel_length)).float()
-        texts = torch.zeros((batch_size, max_text_length)).long()
-        ref_texts = torch.zeros((batch_size, max_rtext_length)).long()
-
-        input_lengths = torch.zeros(batch_size).long()
-        ref_lengths = torch.zeros(batch_size).long()
-        output_lengths = torch.zeros(batch_size).long()
-        ref_mels = torch.zeros((batch_size, nmels, self.max_mel_length)).float()
-        ref_labels = torch.zeros((batch_size)).long()
-        paths = ['' for _ in range(batch_size)]
-        waves = [None for _ in range(batch_size)]
-        
-        for bid, (label, mel, text, ref_text, ref_mel, ref_label, path, wave) in enumerate(batch):
-            mel_size = mel.size(1)
-            text_size = text.size(0)
-            rtext_size = ref_text.size(0)
-            labels[bid] = label
-            mels[bid, :, :mel_size] = mel
-            texts[bid, :text_size] = text
-            ref_texts[bid, :rtext_size] = ref_text
-            input_lengths[bid] = text_size
-            ref_lengths[bid] = rtext_size
-            output_lengths[bid] = mel_size
-            paths[bid] = path
-            ref_mel_size = ref_mel.size(1)
-            ref_mels[bid, :, :ref_mel_size] = ref_mel
-            
-            ref_labels[bid] = ref_label
-            waves[bid] = wave
-
-        return waves, texts, input_lengths, ref_texts, ref_lengths, mels, output_lengths, ref_mels
+        max_mel_length = batch[0][1].shape[1]
+        mels, output_lengths = self._pad(slot, 'mels', [b[1] for b in batch], max_mel_length, torch.float32, nmels)
+        texts, input_lengths = self._pad(slot, 'texts', [b[2] for b in batch], max(len(b[2]) for b in batch), torch.long)
+        ref_texts, ref_lengths = self._pad(slot, 'ref_texts', [b[3] for b in batch], max(len(b[3]) for b in batch), torch.long)
+        ref_mels, _ = self._pad(slot, 'ref_mels', [b[4] for b in batch], self.max_mel_length, torch.float32, nmels)
 
+        waves = [torch.from_numpy(np.asarray(b[7])) for b in batch]
+        if self.wave_dtype == torch.int16:
+            waves = [(wave.clamp(-1, 1) * 32767).round() for wave in waves]
+        waves, wave_lengths = self._pad(slot, 'waves', waves, max(len(wave) for wave in waves), self.wave_dtype)
 
+        return Batch(waves, texts, input_lengths, ref_texts, ref_lengths, mels, output_lengths, ref_mels, wave_lengths, slot)
 
 def build_dataloader(path_list,
                      root_path,
@@ -239,17 +608,35 @@ def build_dataloader(path_list,
                      num_workers=1,
                      device='cpu',
                      collate_config={},
-                     dataset_config={}):
+                     dataset_config={},
+                     sampler_config={}):
     
-    dataset = FilePathDataset(path_list, root_path, OOD_data=OOD_data, min_length=min_length, validation=validation, **dataset_config)
-    collate_fn = Collater(**collate_config)
+    # a shard directory replaces the audio directory, see `python preprocess.py shards`
+    dataset_class = ShardDataset if osp.isfile(osp.join(root_path, SHARD_INDEX)) else FilePathDataset
+    dataset = dataset_class(path_list, root_path, OOD_data=OOD_data, min_length=min_length, validation=validation, **dataset_config)
+    # the waves cross the worker pipe in the storage dtype of the dataset, and without workers the
+    # batches are collated straight into pinned memory
+    pin_buffers = device != 'cpu' and num_workers == 0 and torch.cuda.is_available()
+    collate_fn = Collater(**{'wave_dtype': dataset_config.get('wave_dtype', 'float32'), 'pin_buffers': pin_buffers,
+                             **collate_config})
+    pin_memory = device != 'cpu' and not collate_fn.pin_buffers
+
+    if sampler_config and not validation:
+        # length bucketing, see `BucketBatchSampler` for the keys of sampler_config
+        batch_sampler = BucketBatchSampler(dataset.mel_lengths(), batch_size, **sampler_config)
+        data_loader = DataLoader(dataset,
+                                 batch_sampler=batch_sampler,
+                                 num_workers=num_workers,
+                                 collate_fn=collate_fn,
+                                 pin_memory=pin_memory)
+        return data_loader
+
     data_loader = DataLoader(dataset,
                              batch_size=batch_size,
                              shuffle=(not validation),
                              num_workers=num_workers,
                              drop_last=(not validation),
                              collate_fn=collate_fn,
-                             pin_memory=(device != 'cpu'))
+                             pin_memory=pin_memory)
 
     return data_loader
-
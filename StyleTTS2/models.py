@@ -10,7 +10,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
+from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm, remove_spectral_norm
+from torch.nn.utils import parametrize
+from torch.nn.utils.weight_norm import WeightNorm
+from torch.nn.utils.spectral_norm import SpectralNorm
 
 from Utils.ASR.models import ASRCNN
 from Utils.JDC.model import JDCNet
@@ -20,6 +23,7 @@ from Modules.diffusion.modules import Transformer1d, StyleTransformer1d
 from Modules.diffusion.diffusion import AudioDiffusionConditional
 
 from Modules.discriminators import MultiPeriodDiscriminator, MultiResSpecDiscriminator, WavLMDiscriminator
+from Modules.utils import masked_instance_norm
 
 from munch import Munch
 import yaml
@@ -64,7 +68,7 @@ class DownSample(nn.Module):
         super().__init__()
         self.layer_type = layer_type
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         if self.layer_type == 'none':
             return x
         elif self.layer_type == 'timepreserve':
@@ -72,6 +76,12 @@ class DownSample(nn.Module):
         elif self.layer_type == 'half':
             if x.shape[-1] % 2 != 0:
                 x = torch.cat([x, x[..., -1].unsqueeze(-1)], dim=-1)
+            if lengths is not None:
+                # repeat the last frame of odd lengths into the padding, as for an unpadded input
+                frames = torch.arange(x.shape[-1], device=x.device).view(1, 1, 1, -1)
+                lengths = lengths.view(-1, 1, 1, 1)
+                last = x.gather(-1, (lengths - 1).clamp(min=0).expand(-1, x.shape[1], x.shape[2], 1))
+                x = torch.where((frames == lengths) & (lengths % 2 == 1), last, x)
             return F.avg_pool2d(x, 2)
         else:
             raise RuntimeError('Got unexpected donwsampletype %s, expected is [none, timepreserve, half]' % self.layer_type)
@@ -93,6 +103,15 @@ class UpSample(nn.Module):
             raise RuntimeError('Got unexpected upsampletype %s, expected is [none, timepreserve, half]' % self.layer_type)
 
 
+def time_mask(lengths, x):
+    # [B, 1, 1, T] float mask of the first lengths frames of x
+    frames = torch.arange(x.shape[-1], device=x.device)
+    return (frames[None, :] < lengths[:, None]).to(x.dtype)[:, None, None, :]
+
+def downsampled_lengths(layer_type, lengths):
+    # ceil for 'half', see `DownSample` and `LearnedDownSample`
+    return (lengths + 1) // 2 if layer_type == 'half' else lengths
+
 class ResBlk(nn.Module):
     def __init__(self, dim_in, dim_out, actv=nn.LeakyReLU(0.2),
                  normalize=False, downsample='none'):
@@ -113,27 +132,33 @@ class ResBlk(nn.Module):
         if self.learned_sc:
             self.conv1x1 = spectral_norm(nn.Conv2d(dim_in, dim_out, 1, 1, 0, bias=False))
 
-    def _shortcut(self, x):
+    def _shortcut(self, x, lengths=None):
         if self.learned_sc:
             x = self.conv1x1(x)
         if self.downsample:
-            x = self.downsample(x)
+            x = self.downsample(x, lengths)
         return x
 
-    def _residual(self, x):
+    def _residual(self, x, lengths=None):
         if self.normalize:
             x = self.norm1(x)
         x = self.actv(x)
         x = self.conv1(x)
+        if lengths is not None:
+            x = x * time_mask(lengths, x)
         x = self.downsample_res(x)
+        if lengths is not None:
+            x = x * time_mask(downsampled_lengths(self.downsample.layer_type, lengths), x)
         if self.normalize:
             x = self.norm2(x)
         x = self.actv(x)
         x = self.conv2(x)
         return x
 
-    def forward(self, x):
-        x = self._shortcut(x) + self._residual(x)
+    def forward(self, x, lengths=None):
+        """lengths (time frames of every item) keeps the padding of x zero between the convolutions, see `StyleEncoder`."""
+        assert lengths is None or not self.normalize, 'the instance norms of ResBlk are not masked'
+        x = self._shortcut(x, lengths) + self._residual(x, lengths)
         return x / math.sqrt(2)  # unit variance
 
 class StyleEncoder(nn.Module):
@@ -156,13 +181,38 @@ class StyleEncoder(nn.Module):
 
         self.unshared = nn.Linear(dim_out, style_dim)
 
-    def forward(self, x):
-        h = self.shared(x)
+    def forward(self, x, lengths=None):
+        """
+        x is a mel batch [B, 1, n_mels, T]. With lengths, the mel frames of every item, padded items
+        are encoded as if they were cropped to their length.
+        """
+        h = self.shared(x) if lengths is None else self._masked_shared(x, lengths)
         h = h.view(h.size(0), -1)
         s = self.unshared(h)
     
         return s
 
+    def _masked_shared(self, x, lengths):
+        # the padding is zeroed after every layer, so that the convolutions read it as their own zero padding
+        lengths = lengths.long()
+        h = x * time_mask(lengths, x)
+        for layer in self.shared:
+            if isinstance(layer, ResBlk):
+                h = layer(h, lengths)
+                lengths = downsampled_lengths(layer.downsample.layer_type, lengths)
+            elif isinstance(layer, nn.Conv2d):
+                h = layer(h)
+                lengths = lengths + 2 * layer.padding[1] - layer.kernel_size[1] + 1
+            elif isinstance(layer, nn.AdaptiveAvgPool2d):
+                # mean over the frequencies and the valid frames
+                h = (h * time_mask(lengths, h)).sum(dim=(2, 3), keepdim=True) / (lengths.view(-1, 1, 1, 1) * h.shape[2])
+                lengths = torch.ones_like(lengths)
+                continue
+            else:
+                h = layer(h)
+            h = h * time_mask(lengths, h)
+        return h
+
 class LinearNorm(torch.nn.Module):
     def __init__(self, in_dim, out_dim, bias=True, w_init_gain='linear'):
         super(LinearNorm, self).__init__()
@@ -331,13 +381,15 @@ class TextEncoder(nn.Module):
         return x
 
     def inference(self, x):
+        # same as forward for unpadded inputs, without packing and masking
         x = self.embedding(x)
         x = x.transpose(1, 2)
-        x = self.cnn(x)
+        for c in self.cnn:
+            x = c(x)
         x = x.transpose(1, 2)
         self.lstm.flatten_parameters()
         x, _ = self.lstm(x)
-        return x
+        return x.transpose(-1, -2)
     
     def length_to_mask(self, lengths):
         mask = torch.arange(lengths.max()).unsqueeze(0).expand(lengths.shape[0], -1).type_as(lengths)
@@ -352,11 +404,14 @@ class AdaIN1d(nn.Module):
         self.norm = nn.InstanceNorm1d(num_features, affine=False)
         self.fc = nn.Linear(style_dim, num_features*2)
 
-    def forward(self, x, s):
+    def forward(self, x, s, mask=None):
         h = self.fc(s)
         h = h.view(h.size(0), h.size(1), 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
-        return (1 + gamma) * self.norm(x) + beta
+        if mask is None:
+            return (1 + gamma) * self.norm(x) + beta
+        # padded batch: statistics over the valid frames, padding is zeroed for the next conv
+        return ((1 + gamma) * masked_instance_norm(x, mask, self.norm.eps) + beta) * mask
 
 class UpSample1d(nn.Module):
     def __init__(self, layer_type):
@@ -400,18 +455,21 @@ class AdainResBlk1d(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, s, mask=None):
+        x = self.norm1(x, s, mask)
         x = self.actv(x)
         x = self.pool(x)
+        if mask is not None:
+            mask = self.upsample(mask)
+            x = x * mask
         x = self.conv1(self.dropout(x))
-        x = self.norm2(x, s)
+        x = self.norm2(x, s, mask)
         x = self.actv(x)
         x = self.conv2(self.dropout(x))
         return x
 
-    def forward(self, x, s):
-        out = self._residual(x, s)
+    def forward(self, x, s, mask=None):
+        out = self._residual(x, s, mask)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
     
@@ -494,17 +552,27 @@ class ProsodyPredictor(nn.Module):
 
         return duration.squeeze(-1), en
     
-    def F0Ntrain(self, x, s):
-        x, _ = self.shared(x.transpose(-1, -2))
+    def F0Ntrain(self, x, s, mask=None):
+        """
+        mask ([B, 1, T] float, optional): valid frames of a padded batch, only needed when
+        the utterances in the batch have different lengths.
+        """
+        x = x.transpose(-1, -2)
+        if mask is not None:
+            lengths = mask.squeeze(1).sum(dim=-1).long().cpu()
+            x = nn.utils.rnn.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        x, _ = self.shared(x)
+        if mask is not None:
+            x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=mask.shape[-1])
         
         F0 = x.transpose(-1, -2)
         for block in self.F0:
-            F0 = block(F0, s)
+            F0 = block(F0, s, mask)
         F0 = self.F0_proj(F0)
 
         N = x.transpose(-1, -2)
         for block in self.N:
-            N = block(N, s)
+            N = block(N, s, mask)
         N = self.N_proj(N)
         
         return F0.squeeze(1), N.squeeze(1)
@@ -569,12 +637,23 @@ class DurationEncoder(nn.Module):
         return x.transpose(-1, -2)
     
     def inference(self, x, style):
-        x = self.embedding(x.transpose(-1, -2)) * math.sqrt(self.d_model)
-        style = style.expand(x.shape[0], x.shape[1], -1)
-        x = torch.cat([x, style], axis=-1)
-        src = self.pos_encoder(x)
-        output = self.transformer_encoder(src).transpose(0, 1)
-        return output
+        # same as forward for unpadded inputs, without packing and masking
+        x = x.permute(2, 0, 1)
+        s = style.expand(x.shape[0], x.shape[1], -1)
+        x = torch.cat([x, s], axis=-1)
+        x = x.transpose(0, 1).transpose(-1, -2)
+
+        for block in self.lstms:
+            if isinstance(block, AdaLayerNorm):
+                x = block(x.transpose(-1, -2), style).transpose(-1, -2)
+                x = torch.cat([x, s.permute(1, -1, 0)], axis=1)
+            else:
+                x = x.transpose(-1, -2)
+                block.flatten_parameters()
+                x, _ = block(x)
+                x = x.transpose(-1, -2)
+
+        return x.transpose(-1, -2)
     
     def length_to_mask(self, lengths):
         mask = torch.arange(lengths.max()).unsqueeze(0).expand(lengths.shape[0], -1).type_as(lengths)
@@ -713,3 +792,35 @@ def load_checkpoint(model, optimizer, path, load_only_params=True, ignore_module
         iters = 0
         
     return model, optimizer, epoch, iters
+
+def _remove_parametrizations(module):
+    # torch.nn.utils.weight_norm / spectral_norm register forward pre hooks
+    for hook in list(module._forward_pre_hooks.values()):
+        if isinstance(hook, WeightNorm):
+            remove_weight_norm(module, hook.name)
+        elif isinstance(hook, SpectralNorm):
+            remove_spectral_norm(module, hook.name)
+    # torch.nn.utils.parametrizations register parametrizations instead
+    if parametrize.is_parametrized(module):
+        for name in list(module.parametrizations.keys()):
+            parametrize.remove_parametrizations(module, name, leave_parametrized=True)
+
+def freeze_for_inference(nets):
+    """
+    Prepares trained nets for inference only: bakes weight_norm and spectral_norm into plain
+    weights so they are not recomputed at every forward, replaces dropout by identities and
+    switches to eval mode without gradients.
+
+    Spectral norm is folded with its stored power iteration vectors, exactly as in eval mode,
+    so the outputs are unchanged. The nets cannot be trained afterwards.
+    """
+    for key in nets:
+        net = nets[key]
+        net.eval()
+        for module in list(net.modules()):
+            _remove_parametrizations(module)
+            for name, child in list(module.named_children()):
+                if isinstance(child, nn.Dropout):
+                    setattr(module, name, nn.Identity())
+        net.requires_grad_(False)
+    return nets
@@ -0,0 +1,177 @@
+#coding:utf-8
+import os
+import os.path as osp
+import sqlite3
+import hashlib
+from multiprocessing import Pool
+
+# name -> backend class, see `register_backend`
+BACKENDS = {}
+
+def register_backend(name):
+    """
+    Registers a phonemizer backend. A backend is built with the language and called with a list
+    of texts, it returns their phonemes in the symbols of `TextCleaner`. Bump its `version` when
+    its output changes so that the cached phonemes are recomputed.
+    """
+    def register(cls):
+        BACKENDS[name] = cls
+        return cls
+    return register
+
+@register_backend('espeak')
+class EspeakBackend:
+    """espeak-ng through the phonemizer package, the espeak instance is kept for the life of the process."""
+    version = 1
+
+    def __init__(self, language='ar'):
+        from phonemizer.backend import EspeakBackend as _EspeakBackend
+        self.backend = _EspeakBackend(language=language, preserve_punctuation=True, with_stress=True)
+
+    def __call__(self, texts):
+        return self.backend.phonemize(texts, strip=True)
+
+_DARIJA_LETTERS = {
+    'ا': 'a', 'أ': 'a', 'إ': 'i', 'آ': 'aː', 'ى': 'a', 'ة': 'a',
+    'ء': 'ʔ', 'ئ': 'ʔ', 'ؤ': 'ʔ',
+    'ب': 'b', 'ت': 't', 'ث': 't', 'ج': 'ʒ', 'ح': 'ħ', 'خ': 'χ', 'د': 'd', 'ذ': 'd',
+    'ر': 'r', 'ز': 'z', 'س': 's', 'ش': 'ʃ', 'ص': 'sˤ', 'ض': 'dˤ', 'ط': 'tˤ', 'ظ': 'dˤ',
+    'ع': 'ʕ', 'غ': 'ɣ', 'ف': 'f', 'ق': 'q', 'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n',
+    'ه': 'h', 'ڨ': 'g', 'ڭ': 'g', 'ڤ': 'v', 'پ': 'p',
+    # diacritics, fatha, damma, kasra and the tanween
+    'َ': 'a', 'ُ': 'u', 'ِ': 'i', 'ً': 'an', 'ٌ': 'un', 'ٍ': 'in',
+    '،': ',', '؟': '?', '؛': ';',
+}
+_SHADDA, _SUKUN, _TATWEEL = 'ّ', 'ْ', 'ـ'
+_VOWELS = set('aiuː')
+
+@register_backend('darija')
+class DarijaBackend:
+    """
+    Rule based grapheme to phoneme for Darija in Arabic script. Unvocalized و and ي are read as
+    w and j at the start of a word, after a vowel or before one, and as u and i otherwise. Latin
+    words (French code switching) are kept lowercased.
+    """
+    version = 1
+
+    def __init__(self, language=None):
+        pass
+
+    def _word(self, word):
+        phonemes = []
+        for i, char in enumerate(word):
+            if char in 'وي':
+                after_vowel = i == 0 or (phonemes and phonemes[-1][-1] in _VOWELS)
+                before_vowel = i + 1 < len(word) and word[i + 1] in 'اىةَُِ'
+                if after_vowel or before_vowel:
+                    phonemes.append('w' if char == 'و' else 'j')
+                else:
+                    phonemes.append('u' if char == 'و' else 'i')
+            elif char == _SHADDA:
+                if phonemes:
+                    phonemes.append(phonemes[-1])
+            elif char in (_SUKUN, _TATWEEL):
+                continue
+            else:
+                phonemes.append(_DARIJA_LETTERS.get(char, char.lower()))
+        return ''.join(phonemes)
+
+    def __call__(self, texts):
+        return [' '.join(self._word(word) for word in text.split()) for text in texts]
+
+class PhonemeCache:
+    """
+    Phonemes keyed by a hash of the backend, its version and language and the text, in one sqlite
+    file. Only open it in one process at a time per connection, workers compute and the owner stores.
+    """
+
+    def __init__(self, path):
+        if osp.dirname(path):
+            os.makedirs(osp.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS phonemes (key TEXT PRIMARY KEY, phonemes TEXT)')
+        self.db.commit()
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = 'SELECT key, phonemes FROM phonemes WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            found.update(self.db.execute(query, chunk).fetchall())
+        return found
+
+    def put_many(self, items):
+        self.db.executemany('INSERT OR REPLACE INTO phonemes VALUES (?, ?)', items)
+        self.db.commit()
+
+_backend = None
+
+def _init_backend(name, language):
+    global _backend
+    _backend = BACKENDS[name](language)
+
+def _run_backend(texts):
+    return _backend(texts)
+
+class Phonemizer:
+    """
+    Maps raw text to phonemes with a backend of `BACKENDS`. Texts are phonemized in batches, in
+    worker processes with num_workers > 1, and every result is kept in memory and in the optional
+    sqlite cache, so a text is phonemized once. Training lists (`python preprocess.py phonemize`)
+    and `InferenceEngine` share the cache when given the same cache_path.
+
+    Args:
+      backend (str): name of the backend, 'espeak' or 'darija'.
+      language (str): language of the backend, e.g. 'ar' for espeak.
+      cache_path (str): sqlite file of the persistent cache, memory only if None.
+      num_workers (int): worker processes for large batches.
+      batch_size (int): texts per backend call.
+    """
+
+    def __init__(self, backend='espeak', language='ar', cache_path=None, num_workers=0, batch_size=256):
+        assert backend in BACKENDS, 'Unknown phonemizer backend %s, one of %s' % (backend, sorted(BACKENDS))
+        self.backend_name = backend
+        self.language = language
+        self.ident = '%s:%s:%s' % (backend, BACKENDS[backend].version, language)
+        self.cache = PhonemeCache(cache_path) if cache_path is not None else None
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self._backend = None
+        self._memo = {}
+
+    def key(self, text):
+        return hashlib.sha1((self.ident + '\n' + text).encode('utf-8')).hexdigest()
+
+    def _run(self, texts):
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if self.num_workers > 1 and len(batches) > 1:
+            with Pool(self.num_workers, initializer=_init_backend, initargs=(self.backend_name, self.language)) as pool:
+                results = pool.map(_run_backend, batches)
+        else:
+            if self._backend is None:
+                self._backend = BACKENDS[self.backend_name](self.language)
+            results = [self._backend(batch) for batch in batches]
+        return [ps for batch in results for ps in batch]
+
+    def phonemize(self, texts):
+        keys = [self.key(text) for text in texts]
+        missing = {k for k in keys if k not in self._memo}
+        if missing and self.cache is not None:
+            self._memo.update(self.cache.get_many(missing))
+            missing = {k for k in missing if k not in self._memo}
+
+        if missing:
+            todo = {}
+            for text, k in zip(texts, keys):
+                if k in missing:
+                    todo[k] = text
+            results = list(zip(todo.keys(), self._run(list(todo.values()))))
+            self._memo.update(results)
+            if self.cache is not None:
+                self.cache.put_many(results)
+        return [self._memo[k] for k in keys]
+
+    def __call__(self, text):
+        return self.phonemize([text])[0]
@@ -0,0 +1,209 @@
+#coding:utf-8
+import os
+import os.path as osp
+import json
+from multiprocessing import Pool
+
+import yaml
+import click
+import librosa
+import numpy as np
+import soundfile as sf
+from tqdm import tqdm
+
+from phonemize import BACKENDS, Phonemizer
+from meldataset import MelCache, load_wave, RESAMPLED_MANIFEST, SHARD_INDEX
+from utils import get_data_path_list
+
+def read_lists(config):
+    data_params = config['data_params']
+    train_list, val_list = get_data_path_list(data_params['train_data'], data_params['val_data'])
+    return [l.strip().split('|') for l in train_list + val_list if l.strip()], data_params
+
+@click.group()
+def cli():
+    """Offline preprocessing of the training data, each stage reads the lists of the training config."""
+    pass
+
+_mel_cache = None
+
+def _init_mel_cache(cache_dir, wave_dtype):
+    global _mel_cache
+    _mel_cache = MelCache(cache_dir, wave_dtype=wave_dtype)
+
+def _cache_mel(path):
+    _mel_cache.get(path)
+
+@cli.command()
+@click.option('-p', '--config_path', default='Configs/config.yml', type=str)
+@click.option('--num_workers', default=4, type=int)
+def mels(config_path, num_workers):
+    """Fills the mel cache of data_params.dataset_config.mel_cache_dir."""
+    config = yaml.safe_load(open(config_path))
+    items, data_params = read_lists(config)
+    dataset_config = data_params.get('dataset_config', {})
+    cache_dir = dataset_config.get('mel_cache_dir')
+    assert cache_dir, 'Set data_params.dataset_config.mel_cache_dir in %s' % config_path
+
+    audio_dir = dataset_config.get('resampled_dir') or data_params['root_path']
+    paths = sorted(set(osp.join(audio_dir, item[0]) for item in items))
+    with Pool(num_workers, initializer=_init_mel_cache,
+              initargs=(cache_dir, dataset_config.get('wave_dtype', 'float32'))) as pool:
+        for _ in tqdm(pool.imap_unordered(_cache_mel, paths, chunksize=16), total=len(paths)):
+            pass
+
+SUBTYPES = {'float32': 'FLOAT', 'int16': 'PCM_16'}
+
+def _resample(job):
+    wave_path, source, target, sr, wave_dtype = job
+    stat = os.stat(source)
+    wave, file_sr = sf.read(source, dtype='float32', always_2d=True)
+    channels = wave.shape[1]
+    wave = wave.mean(axis=1)
+    if file_sr != sr:
+        wave = librosa.resample(wave, orig_sr=file_sr, target_sr=sr)
+    if wave_dtype == 'int16':
+        wave = np.clip(wave, -1, 1)
+
+    os.makedirs(osp.dirname(target), exist_ok=True)
+    # write then rename so an interrupted run never leaves a truncated file behind
+    tmp = target + '.%d.tmp' % os.getpid()
+    sf.write(tmp, wave, sr, subtype=SUBTYPES[wave_dtype], format='WAV')
+    os.replace(tmp, target)
+    return wave_path, {'source_size': stat.st_size, 'source_mtime': stat.st_mtime_ns,
+                       'source_sr': file_sr, 'source_channels': channels, 'frames': len(wave)}
+
+@cli.command()
+@click.option('-p', '--config_path', default='Configs/config.yml', type=str)
+@click.option('--num_workers', default=4, type=int)
+@click.option('--sr', default=24000, type=int)
+@click.option('--force', is_flag=True, help='convert every file, even the unchanged ones')
+def resample(config_path, num_workers, sr, force):
+    """
+    Converts the audio of the lists to mono wavs at sr in data_params.dataset_config.resampled_dir,
+    stored as data_params.dataset_config.wave_dtype. Files unchanged since the last run are skipped.
+    """
+    config = yaml.safe_load(open(config_path))
+    items, data_params = read_lists(config)
+    dataset_config = data_params.get('dataset_config', {})
+    out_dir = dataset_config.get('resampled_dir')
+    assert out_dir, 'Set data_params.dataset_config.resampled_dir in %s' % config_path
+    wave_dtype = dataset_config.get('wave_dtype', 'float32')
+    assert wave_dtype in SUBTYPES, wave_dtype
+
+    manifest_path = osp.join(out_dir, RESAMPLED_MANIFEST)
+    manifest = {'sr': sr, 'wave_dtype': wave_dtype, 'files': {}}
+    if osp.isfile(manifest_path) and not force:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous['sr'] == sr and previous['wave_dtype'] == wave_dtype:
+            manifest['files'] = previous['files']
+
+    jobs = []
+    for wave_path in sorted(set(item[0] for item in items)):
+        source, target = osp.join(data_params['root_path'], wave_path), osp.join(out_dir, wave_path)
+        stat = os.stat(source)
+        entry = manifest['files'].get(wave_path)
+        if entry is not None and osp.isfile(target) and \
+           (entry['source_size'], entry['source_mtime']) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        jobs.append((wave_path, source, target, sr, wave_dtype))
+    print('%d of %d files to convert' % (len(jobs), len(set(item[0] for item in items))))
+
+    with Pool(num_workers) as pool:
+        for wave_path, entry in tqdm(pool.imap_unordered(_resample, jobs, chunksize=4), total=len(jobs)):
+            manifest['files'][wave_path] = entry
+
+    os.makedirs(out_dir, exist_ok=True)
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+def _read_wave(path):
+    return load_wave(path).astype(np.float32)
+
+@cli.command()
+@click.option('-p', '--config_path', default='Configs/config.yml', type=str)
+@click.option('-o', '--output_dir', required=True, type=str)
+@click.option('--shard_mb', default=1024, type=int, help='size of a shard file')
+@click.option('--num_workers', default=4, type=int)
+def shards(config_path, output_dir, shard_mb, num_workers):
+    """
+    Packs the waves of the lists into a few shard_*.bin files and an index.npz in output_dir,
+    stored as data_params.dataset_config.wave_dtype. Point data_params.root_path to output_dir to
+    train from the shards.
+    """
+    config = yaml.safe_load(open(config_path))
+    items, data_params = read_lists(config)
+    dataset_config = data_params.get('dataset_config', {})
+    wave_dtype = dataset_config.get('wave_dtype', 'float32')
+    assert wave_dtype in SUBTYPES, wave_dtype
+    audio_dir = dataset_config.get('resampled_dir') or data_params['root_path']
+    os.makedirs(output_dir, exist_ok=True)
+
+    # the audio of every path once, the texts and speakers stay in the lists
+    paths = sorted({item[0] for item in items})
+
+    shard, offset, length = [], [], []
+    shard_id, shard_size, shard_bytes = 0, 0, shard_mb << 20
+    itemsize = np.dtype(wave_dtype).itemsize
+    f = open(osp.join(output_dir, 'shard_%04d.bin' % shard_id), 'wb')
+    with Pool(num_workers) as pool:
+        waves = pool.imap(_read_wave, [osp.join(audio_dir, path) for path in paths], chunksize=4)
+        for wave in tqdm(waves, total=len(paths)):
+            if shard_size > 0 and (shard_size + len(wave)) * itemsize > shard_bytes:
+                f.close()
+                shard_id, shard_size = shard_id + 1, 0
+                f = open(osp.join(output_dir, 'shard_%04d.bin' % shard_id), 'wb')
+            if wave_dtype == 'int16':
+                wave = (np.clip(wave, -1, 1) * 32767).astype(np.int16)
+            f.write(wave.tobytes())
+            shard.append(shard_id)
+            offset.append(shard_size)
+            length.append(len(wave))
+            shard_size += len(wave)
+    f.close()
+
+    np.savez(osp.join(output_dir, SHARD_INDEX),
+             path=np.array(paths), shard=np.array(shard, dtype=np.int32),
+             offset=np.array(offset, dtype=np.int64), length=np.array(length, dtype=np.int64),
+             sr=24000, wave_dtype=wave_dtype)
+    print('%d waves in %d shards' % (len(paths), shard_id + 1))
+
+@cli.command('phonemize')
+@click.option('-p', '--config_path', default='Configs/config.yml', type=str)
+@click.option('--backend', default='espeak', type=click.Choice(sorted(BACKENDS)))
+@click.option('--language', default='ar', type=str)
+@click.option('--cache_path', default='Data/phonemes.sqlite', type=str, help='shared with inference.py --phoneme_cache')
+@click.option('--num_workers', default=4, type=int)
+@click.option('--suffix', default='_phonemized', type=str)
+def phonemize_lists(config_path, backend, language, cache_path, num_workers, suffix):
+    """
+    Phonemizes the texts of the train, val and OOD lists of the config, written next to them with
+    suffix. Point data_params to the new lists to train on phonemes.
+    """
+    config = yaml.safe_load(open(config_path))
+    data_params = config['data_params']
+    phonemizer = Phonemizer(backend, language, cache_path=cache_path, num_workers=num_workers)
+
+    for key in ['train_data', 'val_data', 'OOD_data']:
+        path = data_params.get(key)
+        if path is None:
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = [l.rstrip('\n').split('|') for l in f.readlines() if l.strip()]
+        # the OOD texts are either text|anything or path|text|...
+        idx = 1 if key != 'OOD_data' or '.wav' in lines[0][0] else 0
+        phonemes = phonemizer.phonemize([l[idx] for l in lines])
+        for l, ps in zip(lines, phonemes):
+            l[idx] = ps
+
+        root, ext = osp.splitext(path)
+        output_path = root + suffix + ext
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.writelines('|'.join(l) + '\n' for l in lines)
+        print('%s: %s' % (key, output_path))
+
+if __name__=="__main__":
+    cli()
@@ -0,0 +1,81 @@
+#coding:utf-8
+import os
+import os.path as osp
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+def checkpoint_id(path):
+    # checkpoints are too large to hash at every start, the path, size and mtime identify them well enough
+    stat = os.stat(path)
+    ident = '%s:%d:%d' % (osp.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()[:16]
+
+class StyleCache:
+    """
+    Style vectors of reference clips, keyed by a hash of the audio bytes and the checkpoint id.
+
+    A small in-memory LRU sits in front of an optional directory of .npy files, so a reference
+    is decoded and encoded once per checkpoint and never again, even across processes.
+
+    Args:
+      cache_dir (str): directory of the on-disk store, memory only if None.
+      checkpoint (str): id of the checkpoint the styles were computed with, see `checkpoint_id`.
+      max_items (int): size of the in-memory LRU.
+    """
+
+    def __init__(self, cache_dir=None, checkpoint='', max_items=128):
+        self.cache_dir = cache_dir
+        self.checkpoint = checkpoint
+        self.max_items = max_items
+        self._styles = OrderedDict()
+        # (path, size, mtime) -> key, so an unchanged file is only hashed once per process
+        self._keys = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path):
+        stat = os.stat(path)
+        file_id = (osp.abspath(path), stat.st_size, stat.st_mtime_ns)
+        key = self._keys.get(file_id)
+        if key is None:
+            sha = hashlib.sha1(self.checkpoint.encode('utf-8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            key = sha.hexdigest()
+            self._keys[file_id] = key
+        return key
+
+    def _file(self, key):
+        return osp.join(self.cache_dir, key + '.npy')
+
+    def get(self, path):
+        key = self.key(path)
+        if key in self._styles:
+            self._styles.move_to_end(key)
+            return self._styles[key]
+
+        if self.cache_dir is None or not osp.isfile(self._file(key)):
+            return None
+        style = np.load(self._file(key))
+        self._remember(key, style)
+        return style
+
+    def put(self, path, style):
+        key = self.key(path)
+        style = np.asarray(style, dtype=np.float32)
+        self._remember(key, style)
+        if self.cache_dir is not None:
+            # write then rename so concurrent readers never see a partial file
+            tmp = self._file(key) + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                np.save(f, style)
+            os.replace(tmp, self._file(key))
+
+    def _remember(self, key, style):
+        self._styles[key] = style
+        self._styles.move_to_end(key)
+        while len(self._styles) > self.max_items:
+            self._styles.popitem(last=False)
@@ -1,4 +1,7 @@
 # IPA Phonemizer: https://github.com/bootphon/phonemizer
+from collections import Counter
+
+import numpy as np
 
 _pad = "$"
 _punctuation = ';:,.!?¡¿—…"«»“” '
@@ -13,14 +16,38 @@ for i in range(len((symbols))):
     dicts[symbols[i]] = i
 
 class TextCleaner:
+    """
+    Maps text to symbol ids through a lookup table indexed by code point. Unknown symbols are
+    dropped and counted in `unknown`, `report` summarizes them once instead of printing every text.
+    """
+
     def __init__(self, dummy=None):
         self.word_index_dictionary = dicts
-        print(len(dicts))
-    def __call__(self, text):
-        indexes = []
-        for char in text:
-            try:
-                indexes.append(self.word_index_dictionary[char])
-            except KeyError:
-                print(text)
+        self.lut = np.full(max(ord(c) for c in dicts) + 1, -1, dtype=np.int64)
+        for char, index in dicts.items():
+            self.lut[ord(char)] = index
+        self.unknown = Counter()
+
+    def encode(self, text):
+        """Symbol ids of text as an int64 array."""
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        indexes = np.full(len(codes), -1, dtype=np.int64)
+        inside = codes < len(self.lut)
+        indexes[inside] = self.lut[codes[inside]]
+        known = indexes >= 0
+        if not known.all():
+            self.unknown.update(text[i] for i in np.flatnonzero(~known))
+            return indexes[known]
         return indexes
+
+    def __call__(self, text):
+        return self.encode(text).tolist()
+
+    def report(self):
+        """Summary of the unknown symbols met since the last report, or None."""
+        if not self.unknown:
+            return None
+        counts = ', '.join('%r x%d' % (char, n) for char, n in self.unknown.most_common(20))
+        message = '%d unknown symbols (%d distinct) dropped: %s' % (sum(self.unknown.values()), len(self.unknown), counts)
+        self.unknown.clear()
+        return message
@@ -16,7 +16,7 @@ warnings.simplefilter('ignore')
 from torch.utils.tensorboard import SummaryWriter
 import torch.cuda.amp as amp
 
-from meldataset import build_dataloader
+from meldataset import build_dataloader, wave_to_float
 
 from Utils.ASR.models import ASRCNN
 from Utils.JDC.model import JDCNet
@@ -104,9 +104,9 @@ def main(config_path):
                                         OOD_data=OOD_data,
                                         min_length=min_length,
                                         batch_size=batch_size,
-                                        batch_size=batch_size,
                                         num_workers=num_workers,
-                                        dataset_config={},
+                                        dataset_config=data_params.get('dataset_config', {}),
+                                        sampler_config=data_params.get('sampler_config', {}),
                                         device=device)
 
     val_dataloader = build_dataloader(val_list,
@@ -115,11 +115,9 @@ def main(config_path):
                                       min_length=min_length,
                                       batch_size=batch_size,
                                       validation=True,
-                                      batch_size=batch_size,
-                                      validation=True,
                                       num_workers=num_workers,
                                       device=device,
-                                      dataset_config={})
+                                      dataset_config=data_params.get('dataset_config', {}))
     
     # load pretrained ASR model
     ASR_config = config.get('ASR_config', False)
@@ -256,6 +254,9 @@ def main(config_path):
     for epoch in range(start_epoch, epochs):
         running_loss = 0
         start_time = time.time()
+        if hasattr(train_dataloader.batch_sampler, 'set_epoch'):
+            # keeps the bucketed order of a resumed run identical
+            train_dataloader.batch_sampler.set_epoch(epoch)
 
         _ = [model[key].eval() for key in model]
         
@@ -269,9 +270,10 @@ def main(config_path):
         model.mpd.train()
 
         for i, batch in enumerate(train_dataloader):
-            waves = batch[0]
-            batch = [b.to(device) for b in batch[1:]]
-            texts, input_lengths, ref_texts, ref_lengths, mels, mel_input_length, ref_mels = batch
+            batch = batch.to(device)
+            waves = wave_to_float(batch.waves)
+            texts, input_lengths, ref_texts, ref_lengths = batch.texts, batch.input_lengths, batch.ref_texts, batch.ref_lengths
+            mels, mel_input_length, ref_mels, wave_lengths = batch.mels, batch.output_lengths, batch.ref_mels, batch.wave_lengths
             with torch.no_grad():
                 mask = length_to_mask(mel_input_length // (2 ** n_down)).to(device)
                 mel_mask = length_to_mask(mel_input_length).to(device)
@@ -306,20 +308,9 @@ def main(config_path):
 
             d_gt = s2s_attn_mono.sum(axis=-1).detach()
 
-            # compute the style of the entire utterance
-            # this operation cannot be done in batch because of the avgpool layer (may need to work on masked avgpool)
-            ss = []
-            gs = []
-            for bib in range(len(mel_input_length)):
-                mel_length = int(mel_input_length[bib].item())
-                mel = mels[bib, :, :mel_input_length[bib]]
-                s = model.predictor_encoder(mel.unsqueeze(0).unsqueeze(1))
-                ss.append(s)
-                s = model.style_encoder(mel.unsqueeze(0).unsqueeze(1))
-                gs.append(s)
-
-            s_dur = torch.stack(ss).squeeze()  # global prosodic styles
-            gs = torch.stack(gs).squeeze() # global acoustic styles
+            # compute the style of the entire utterance, the pooling is masked to the length of every mel
+            s_dur = model.predictor_encoder(mels.unsqueeze(1), mel_input_length)  # global prosodic styles
+            gs = model.style_encoder(mels.unsqueeze(1), mel_input_length) # global acoustic styles
             s_trg = torch.cat([gs, s_dur], dim=-1).detach() # ground truth for denoiser
 
             bert_dur = model.bert(texts, attention_mask=(~text_mask).int())
@@ -380,7 +371,7 @@ def main(config_path):
                 gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
                 
                 y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-                wav.append(torch.from_numpy(y).to(device))
+                wav.append(y)
                 
                 # style reference (better to be different from the GT)
                 random_start = np.random.randint(0, mel_length - mel_len_st)
@@ -432,27 +423,9 @@ def main(config_path):
             loss_gen_all = gl(wav, y_rec).mean()
             loss_lm = wl(wav.detach().squeeze(), y_rec.squeeze()).mean()
 
-            loss_ce = 0
-            loss_dur = 0
-            for _s2s_pred, _text_input, _text_length in zip(d, (d_gt), input_lengths):
-                _s2s_pred = _s2s_pred[:_text_length, :]
-                _text_input = _text_input[:_text_length].long()
-                _s2s_trg = torch.zeros_like(_s2s_pred)
-                for p in range(_s2s_trg.shape[0]):
-                    _s2s_trg[p, :_text_input[p]] = 1
-                _dur_pred = torch.sigmoid(_s2s_pred).sum(axis=1)
-
-                loss_dur += F.l1_loss(_dur_pred[1:_text_length-1], 
-                                       _text_input[1:_text_length-1])
-                loss_ce += F.binary_cross_entropy_with_logits(_s2s_pred.flatten(), _s2s_trg.flatten())
-
-            loss_ce /= texts.size(0)
-            loss_dur /= texts.size(0)
+            loss_dur, loss_ce = duration_loss(d, d_gt, input_lengths)
             
-            loss_s2s = 0
-            for _s2s_pred, _text_input, _text_length in zip(s2s_pred, texts, input_lengths):
-                loss_s2s += F.cross_entropy(_s2s_pred[:_text_length], _text_input[:_text_length])
-            loss_s2s /= texts.size(0)
+            loss_s2s = s2s_loss(s2s_pred, texts, input_lengths)
 
             loss_mono = F.l1_loss(s2s_attn, s2s_attn_mono) * 10
 
@@ -577,9 +550,10 @@ def main(config_path):
                 optimizer.zero_grad()
 
                 try:
-                    waves = batch[0]
-                    batch = [b.to(device) for b in batch[1:]]
-                    texts, input_lengths, ref_texts, ref_lengths, mels, mel_input_length, ref_mels = batch
+                    batch = batch.to(device)
+                    waves = wave_to_float(batch.waves)
+                    texts, input_lengths, ref_texts, ref_lengths = batch.texts, batch.input_lengths, batch.ref_texts, batch.ref_lengths
+                    mels, mel_input_length, ref_mels, wave_lengths = batch.mels, batch.output_lengths, batch.ref_mels, batch.wave_lengths
                     with torch.no_grad():
                         mask = length_to_mask(mel_input_length // (2 ** n_down)).to('cuda')
                         text_mask = length_to_mask(input_lengths).to(texts.device)
@@ -598,19 +572,8 @@ def main(config_path):
 
                         d_gt = s2s_attn_mono.sum(axis=-1).detach()
 
-                    ss = []
-                    gs = []
-
-                    for bib in range(len(mel_input_length)):
-                        mel_length = int(mel_input_length[bib].item())
-                        mel = mels[bib, :, :mel_input_length[bib]]
-                        s = model.predictor_encoder(mel.unsqueeze(0).unsqueeze(1))
-                        ss.append(s)
-                        s = model.style_encoder(mel.unsqueeze(0).unsqueeze(1))
-                        gs.append(s)
-
-                    s = torch.stack(ss).squeeze()
-                    gs = torch.stack(gs).squeeze()
+                    s = model.predictor_encoder(mels.unsqueeze(1), mel_input_length)
+                    gs = model.style_encoder(mels.unsqueeze(1), mel_input_length)
                     s_trg = torch.cat([s, gs], dim=-1).detach()
 
                     bert_dur = model.bert(texts, attention_mask=(~text_mask).int())
@@ -636,7 +599,7 @@ def main(config_path):
 
                         gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
                         y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-                        wav.append(torch.from_numpy(y).to(device))
+                        wav.append(y)
 
                     wav = torch.stack(wav).float().detach()
 
@@ -647,18 +610,7 @@ def main(config_path):
 
                     F0_fake, N_fake = model.predictor.F0Ntrain(p_en, s)
 
-                    loss_dur = 0
-                    for _s2s_pred, _text_input, _text_length in zip(d, (d_gt), input_lengths):
-                        _s2s_pred = _s2s_pred[:_text_length, :]
-                        _text_input = _text_input[:_text_length].long()
-                        _s2s_trg = torch.zeros_like(_s2s_pred)
-                        for bib in range(_s2s_trg.shape[0]):
-                            _s2s_trg[bib, :_text_input[bib]] = 1
-                        _dur_pred = torch.sigmoid(_s2s_pred).sum(axis=1)
-                        loss_dur += F.l1_loss(_dur_pred[1:_text_length-1], 
-                                               _text_input[1:_text_length-1])
-
-                    loss_dur /= texts.size(0)
+                    loss_dur, _ = duration_loss(d, d_gt, input_lengths)
 
                     s = model.style_encoder(gt.unsqueeze(1))
 
@@ -22,7 +22,7 @@ import torchaudio
 import librosa
 
 from models import *
-from meldataset import build_dataloader
+from meldataset import build_dataloader, wave_to_float
 from utils import *
 from losses import *
 from optimizers import build_optimizer
@@ -84,7 +84,8 @@ def main(config_path):
                                         min_length=min_length,
                                         batch_size=batch_size,
                                         num_workers=2,
-                                        dataset_config={},
+                                        dataset_config=data_params.get('dataset_config', {}),
+                                        sampler_config=data_params.get('sampler_config', {}),
                                         device=device)
 
     val_dataloader = build_dataloader(val_list,
@@ -95,7 +96,7 @@ def main(config_path):
                                       validation=True,
                                       num_workers=0,
                                       device=device,
-                                      dataset_config={})
+                                      dataset_config=data_params.get('dataset_config', {}))
     
     with accelerator.main_process_first():
         # load pretrained ASR model
@@ -174,13 +175,17 @@ def main(config_path):
     for epoch in range(start_epoch, epochs):
         running_loss = 0
         start_time = time.time()
+        if hasattr(train_dataloader.batch_sampler, 'set_epoch'):
+            # keeps the bucketed order of a resumed run identical
+            train_dataloader.batch_sampler.set_epoch(epoch)
 
         _ = [model[key].train() for key in model]
 
         for i, batch in enumerate(train_dataloader):
-            waves = batch[0]
-            batch = [b.to(device) for b in batch[1:]]
-            texts, input_lengths, _, _, mels, mel_input_length, _ = batch
+            batch = batch.to(device)
+            waves = wave_to_float(batch.waves)
+            texts, input_lengths, mels, mel_input_length = batch.texts, batch.input_lengths, batch.mels, batch.output_lengths
+            wave_lengths = batch.wave_lengths
             
             with torch.no_grad():
                 mask = length_to_mask(mel_input_length // (2 ** n_down)).to('cuda')
@@ -230,7 +235,7 @@ def main(config_path):
                 gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
 
                 y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-                wav.append(torch.from_numpy(y).to(device))
+                wav.append(y)
                 
                 # style reference (better to be different from the GT)
                 random_start = np.random.randint(0, mel_length - mel_len_st)
@@ -270,10 +275,7 @@ def main(config_path):
             loss_mel = stft_loss(y_rec.squeeze(), wav.detach())
             
             if epoch >= TMA_epoch: # start TMA training
-                loss_s2s = 0
-                for _s2s_pred, _text_input, _text_length in zip(s2s_pred, texts, input_lengths):
-                    loss_s2s += F.cross_entropy(_s2s_pred[:_text_length], _text_input[:_text_length])
-                loss_s2s /= texts.size(0)
+                loss_s2s = s2s_loss(s2s_pred, texts, input_lengths)
 
                 loss_mono = F.l1_loss(s2s_attn, s2s_attn_mono) * 10
                     
@@ -331,9 +333,10 @@ def main(config_path):
             for batch_idx, batch in enumerate(val_dataloader):
                 optimizer.zero_grad()
 
-                waves = batch[0]
-                batch = [b.to(device) for b in batch[1:]]
-                texts, input_lengths, _, _, mels, mel_input_length, _ = batch
+                batch = batch.to(device)
+                waves = wave_to_float(batch.waves)
+                texts, input_lengths, mels, mel_input_length = batch.texts, batch.input_lengths, batch.mels, batch.output_lengths
+                wave_lengths = batch.wave_lengths
 
                 with torch.no_grad():
                     mask = length_to_mask(mel_input_length // (2 ** n_down)).to('cuda')
@@ -368,7 +371,7 @@ def main(config_path):
                     en.append(asr[bib, :, random_start:random_start+mel_len])
                     gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
                     y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-                    wav.append(torch.from_numpy(y).to('cuda'))
+                    wav.append(y)
 
                 wav = torch.stack(wav).float().detach()
 
@@ -408,7 +411,7 @@ def main(config_path):
                     
                     writer.add_audio('eval/y' + str(bib), y_rec.cpu().numpy().squeeze(), epoch, sample_rate=sr)
                     if epoch == 0:
-                        writer.add_audio('gt/y' + str(bib), waves[bib].squeeze(), epoch, sample_rate=sr)
+                        writer.add_audio('gt/y' + str(bib), waves[bib, :wave_lengths[bib]].cpu().numpy(), epoch, sample_rate=sr)
                     
                     if bib >= 6:
                         break
@@ -11,7 +11,26 @@ import librosa
 import matplotlib.pyplot as plt
 from munch import Munch
 
+try:
+  import numba
+except ImportError:
+  numba = None
+
 def maximum_path(neg_cent, mask):
+  """ Monotonic alignment search, on the device for GPU tensors, with numba threads
+  on the CPU when numba is installed and with the Cython version otherwise.
+  neg_cent: [b, t_t, t_s]
+  mask: [b, t_t, t_s]
+  """
+  if neg_cent.is_cuda:
+    t_t_max = mask.sum(1)[:, 0].long()
+    t_s_max = mask.sum(2)[:, 0].long()
+    return maximum_path_torch(neg_cent.detach(), t_t_max, t_s_max).to(dtype=neg_cent.dtype)
+  if numba is not None:
+    return maximum_path_numba(neg_cent, mask)
+  return maximum_path_cython(neg_cent, mask)
+
+def maximum_path_cython(neg_cent, mask):
   """ Cython optimized version.
   neg_cent: [b, t_t, t_s]
   mask: [b, t_t, t_s]
@@ -26,6 +45,93 @@ def maximum_path(neg_cent, mask):
   maximum_path_c(path, neg_cent, t_t_max, t_s_max)
   return torch.from_numpy(path).to(device=device, dtype=dtype)
 
+def maximum_path_torch(neg_cent, t_t_max, t_s_max, max_neg_val=-1e9):
+  """ Batched version of `maximum_path_c` on the device of neg_cent, with the same float32
+  arithmetic so that the paths are identical. The DP runs over the columns (t_s), every column
+  of the whole batch in a few tensor ops, and the backtracking also runs over the columns.
+  neg_cent: [b, t_t, t_s]
+  t_t_max, t_s_max: [b] lengths
+  """
+  b, t_t, t_s = neg_cent.shape
+  device = neg_cent.device
+  value = neg_cent.float().clone()
+  x = torch.arange(t_t, device=device)[None, :]
+  max_neg = torch.tensor(max_neg_val, dtype=torch.float32, device=device)
+  zero_row = torch.full((b, 1), max_neg_val, dtype=torch.float32, device=device)
+
+  for y in range(t_s):
+    if y == 0:
+      v_cur = max_neg.expand(b, t_t)
+      v_prev = torch.where(x == 0, torch.zeros_like(max_neg), max_neg).expand(b, t_t)
+    else:
+      prev = value[:, :, y - 1]
+      v_cur = torch.where(x == y, max_neg, prev)
+      v_prev = torch.cat([zero_row, prev[:, :-1]], dim=1)
+    # cells of the DP, max(0, t_t + y - t_s) <= x < min(t_t, y + 1)
+    region = (x >= (t_t_max + y - t_s_max)[:, None]) & (x < torch.clamp(t_t_max, max=y + 1)[:, None])
+    value[:, :, y] = torch.where(region, torch.maximum(v_cur, v_prev) + value[:, :, y], value[:, :, y])
+
+  batch = torch.arange(b, device=device)
+  index = t_t_max - 1
+  indexes = torch.zeros(b, t_s, dtype=torch.long, device=device)
+  for y in range(t_s - 1, -1, -1):
+    active = y < t_s_max
+    indexes[:, y] = index
+    if y > 0:
+      stay = value[batch, index, y - 1]
+      move = value[batch, (index - 1).clamp(min=0), y - 1]
+      step = active & (index != 0) & ((index == y) | (stay < move))
+      index = index - step.long()
+
+  active = torch.arange(t_s, device=device)[None, :] < t_s_max[:, None]
+  path = torch.zeros(b, t_t, t_s, dtype=torch.int32, device=device)
+  path.scatter_(1, indexes[:, None, :], active[:, None, :].int())
+  return path
+
+if numba is not None:
+  @numba.njit(cache=True)
+  def _maximum_path_each(path, value, t_x, t_y, max_neg_val):
+    index = t_x - 1
+    for y in range(t_y):
+      for x in range(max(0, t_x + y - t_y), min(t_x, y + 1)):
+        if x == y:
+          v_cur = max_neg_val
+        else:
+          v_cur = value[x, y - 1]
+        if x == 0:
+          if y == 0:
+            v_prev = np.float32(0.)
+          else:
+            v_prev = max_neg_val
+        else:
+          v_prev = value[x - 1, y - 1]
+        value[x, y] = max(v_cur, v_prev) + value[x, y]
+
+    for y in range(t_y - 1, -1, -1):
+      path[index, y] = 1
+      if index != 0 and (index == y or value[index, y - 1] < value[index - 1, y - 1]):
+        index = index - 1
+
+  @numba.njit(parallel=True, cache=True)
+  def _maximum_path_batch(paths, values, t_xs, t_ys, max_neg_val):
+    for i in numba.prange(values.shape[0]):
+      _maximum_path_each(paths[i], values[i], t_xs[i], t_ys[i], max_neg_val)
+
+def maximum_path_numba(neg_cent, mask):
+  """ Same as `maximum_path_cython`, with the batch elements spread over numba threads.
+  neg_cent: [b, t_t, t_s]
+  mask: [b, t_t, t_s]
+  """
+  device = neg_cent.device
+  dtype = neg_cent.dtype
+  neg_cent =  np.ascontiguousarray(neg_cent.data.cpu().numpy().astype(np.float32))
+  path =  np.zeros(neg_cent.shape, dtype=np.int32)
+
+  t_t_max = mask.sum(1)[:, 0].data.cpu().numpy().astype(np.int32)
+  t_s_max = mask.sum(2)[:, 0].data.cpu().numpy().astype(np.int32)
+  _maximum_path_batch(path, neg_cent, t_t_max, t_s_max, np.float32(-1e9))
+  return torch.from_numpy(path).to(device=device, dtype=dtype)
+
 def get_data_path_list(train_path=None, val_path=None):
     if train_path is None:
         train_path = "Data/train_list.txt"
@@ -16,7 +16,7 @@ warnings.simplefilter('ignore')
 from torch.utils.tensorboard import SummaryWriter
 import torch.cuda.amp as amp
 
-from meldataset import build_dataloader
+from meldataset import build_dataloader, wave_to_float
 
 from Utils.ASR.models import ASRCNN
 from Utils.JDC.model import JDCNet
@@ -101,7 +101,6 @@ def main(config_path):
                                         OOD_data=OOD_data,
                                         min_length=min_length,
                                         batch_size=batch_size,
-                                        batch_size=batch_size,
                                         num_workers=num_workers,
                                         dataset_config={},
                                         device=device)
@@ -112,8 +111,6 @@ def main(config_path):
                                       min_length=min_length,
                                       batch_size=batch_size,
                                       validation=True,
-                                      batch_size=batch_size,
-                                      validation=True,
                                       num_workers=num_workers,
                                       device=device,
                                       dataset_config={})
@@ -266,9 +263,10 @@ def main(config_path):
         model.mpd.train()
 
         for i, batch in enumerate(train_dataloader):
-            waves = batch[0]
-            batch = [b.to(device) for b in batch[1:]]
-            texts, input_lengths, ref_texts, ref_lengths, mels, mel_input_length, ref_mels = batch
+            batch = batch.to(device)
+            waves = wave_to_float(batch.waves)
+            texts, input_lengths, ref_texts, ref_lengths = batch.texts, batch.input_lengths, batch.ref_texts, batch.ref_lengths
+            mels, mel_input_length, ref_mels, wave_lengths = batch.mels, batch.output_lengths, batch.ref_mels, batch.wave_lengths
             with torch.no_grad():
                 mask = length_to_mask(mel_input_length // (2 ** n_down)).to(device)
                 mel_mask = length_to_mask(mel_input_length).to(device)
@@ -377,7 +375,7 @@ def main(config_path):
                 gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
                 
                 y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-                wav.append(torch.from_numpy(y).to(device))
+                wav.append(y)
                 
                 # style reference (better to be different from the GT)
                 random_start = np.random.randint(0, mel_length - mel_len_st)
@@ -574,9 +572,10 @@ def main(config_path):
                 optimizer.zero_grad()
 
                 try:
-                    waves = batch[0]
-                    batch = [b.to(device) for b in batch[1:]]
-                    texts, input_lengths, ref_texts, ref_lengths, mels, mel_input_length, ref_mels = batch
+                    batch = batch.to(device)
+                    waves = wave_to_float(batch.waves)
+                    texts, input_lengths, ref_texts, ref_lengths = batch.texts, batch.input_lengths, batch.ref_texts, batch.ref_lengths
+                    mels, mel_input_length, ref_mels, wave_lengths = batch.mels, batch.output_lengths, batch.ref_mels, batch.wave_lengths
                     with torch.no_grad():
                         mask = length_to_mask(mel_input_length // (2 ** n_down)).to('cuda')
                         text_mask = length_to_mask(input_lengths).to(texts.device)
@@ -633,7 +632,7 @@ def main(config_path):
 
                         gt.append(mels[bib, :, (random_start * 2):((random_start+mel_len) * 2)])
                         y = waves[bib][(random_start * 2) * 300:((random_start+mel_len) * 2) * 300]
-                        wav.append(torch.from_numpy(y).to(device))
+                        wav.append(y)
 
                     wav = torch.stack(wav).float().detach()
 